@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+
+import argparse
+import imp
+import json
+import logging
+import os
+import os.path
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import uuid
+
+# Keep the filesystems' debug logging out of the measurements. This must
+# happen before they are loaded, as each configures logging on import.
+logging.basicConfig(level=logging.WARNING)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "fuse-etcd-v2"))
+
+import fake_etcd
+
+
+FILESYSTEMS = {
+    "passthrough": "fuse-passthrough/fuse-passthrough.py",
+    "etcd": "fuse-etcd/fuse-etcd.py",
+    "etcd-v2": "fuse-etcd-v2/fuse-etcd-v2.py",
+}
+MODE_DIRECT = "direct"
+MODE_MOUNT = "mount"
+MODES = (MODE_DIRECT, MODE_MOUNT)
+
+
+def _load(name):
+    module_name = name.replace("-", "_")
+    return imp.load_source(module_name, os.path.join(ROOT, FILESYSTEMS[name]))
+
+
+class DirectTarget(object):
+    """Drives an Operations instance by calling its methods directly."""
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def create(self, path):
+        return self.fs.create(path, stat.S_IFREG | 0o644)
+
+    def open(self, path, flags):
+        return self.fs.open(path, flags)
+
+    def read(self, path, size, offset, fh):
+        return self.fs.read(path, size, offset, fh)
+
+    def write(self, path, buf, offset, fh):
+        return self.fs.write(path, buf, offset, fh)
+
+    def release(self, path, fh):
+        self.fs.flush(path, fh)
+        self.fs.release(path, fh)
+
+    def unlink(self, path):
+        self.fs.unlink(path)
+
+    def mkdir(self, path):
+        self.fs.mkdir(path, 0o755)
+
+    def readdir(self, path):
+        return [name for name in self.fs.readdir(path, None)
+                if name not in (".", "..")]
+
+    def getattr(self, path):
+        return self.fs.getattr(path)
+
+
+class MountTarget(object):
+    """Drives a mounted filesystem through system calls."""
+
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+
+    def _path(self, path):
+        return self.mountpoint + path
+
+    def create(self, path):
+        return os.open(self._path(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                       0o644)
+
+    def open(self, path, flags):
+        return os.open(self._path(path), flags)
+
+    def read(self, path, size, offset, fh):
+        os.lseek(fh, offset, os.SEEK_SET)
+        return os.read(fh, size)
+
+    def write(self, path, buf, offset, fh):
+        os.lseek(fh, offset, os.SEEK_SET)
+        return os.write(fh, buf)
+
+    def release(self, path, fh):
+        os.close(fh)
+
+    def unlink(self, path):
+        os.unlink(self._path(path))
+
+    def mkdir(self, path):
+        os.mkdir(self._path(path), 0o755)
+
+    def readdir(self, path):
+        return os.listdir(self._path(path))
+
+    def getattr(self, path):
+        return os.lstat(self._path(path))
+
+
+class Recorder(object):
+    """Records the latency of each operation of a workload."""
+
+    def __init__(self, rpcs):
+        # Returns the number of etcd requests made so far, or None if they
+        # cannot be counted.
+        self.rpcs = rpcs
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.start = None
+        self.end = None
+        self.rpcs_start = None
+        self.rpcs_end = None
+
+    def begin(self):
+        self.rpcs_start = self.rpcs()
+        self.start = timeit.default_timer()
+
+    def finish(self):
+        self.end = timeit.default_timer()
+        self.rpcs_end = self.rpcs()
+
+    def measure(self, func, *args):
+        start = timeit.default_timer()
+        try:
+            result = func(*args)
+        except Exception as e:
+            # Failed operations are counted, but not included in latencies.
+            logging.debug("%s%r failed: %s", func.__name__, args, e)
+            with self.lock:
+                self.errors += 1
+            return None
+        latency = timeit.default_timer() - start
+        with self.lock:
+            self.latencies.append(latency)
+        return result
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+# Workloads
+# =========
+#
+# Each workload prepares any files it needs, then calls recorder.begin(),
+# performs the measured operations through recorder.measure(), and calls
+# recorder.finish().
+
+
+def _write_file(target, path, size, count):
+    fh = target.create(path)
+    for i in range(count):
+        target.write(path, "x" * size, i * size, fh)
+    target.release(path, fh)
+
+
+def seq_write(target, base, recorder, size, count, threads, rng):
+    path = base + "/file"
+    buf = "x" * size
+    fh = target.create(path)
+    recorder.begin()
+    for i in range(count):
+        recorder.measure(target.write, path, buf, i * size, fh)
+    recorder.finish()
+    target.release(path, fh)
+
+
+def seq_read(target, base, recorder, size, count, threads, rng):
+    path = base + "/file"
+    _write_file(target, path, size, count)
+    fh = target.open(path, os.O_RDONLY)
+    recorder.begin()
+    for i in range(count):
+        recorder.measure(target.read, path, size, i * size, fh)
+    recorder.finish()
+    target.release(path, fh)
+
+
+def rand_write(target, base, recorder, size, count, threads, rng):
+    path = base + "/file"
+    _write_file(target, path, size, count)
+    buf = "y" * size
+    fh = target.open(path, os.O_WRONLY)
+    recorder.begin()
+    for _ in range(count):
+        recorder.measure(target.write, path, buf, rng.randrange(count) * size,
+                         fh)
+    recorder.finish()
+    target.release(path, fh)
+
+
+def rand_read(target, base, recorder, size, count, threads, rng):
+    path = base + "/file"
+    _write_file(target, path, size, count)
+    fh = target.open(path, os.O_RDONLY)
+    recorder.begin()
+    for _ in range(count):
+        recorder.measure(target.read, path, size, rng.randrange(count) * size,
+                         fh)
+    recorder.finish()
+    target.release(path, fh)
+
+
+def _create_empty(target, path):
+    target.release(path, target.create(path))
+
+
+def create_unlink(target, base, recorder, size, count, threads, rng):
+    paths = ["%s/f%d" % (base, i) for i in range(count)]
+    recorder.begin()
+    for path in paths:
+        recorder.measure(_create_empty, target, path)
+    for path in paths:
+        recorder.measure(target.unlink, path)
+    recorder.finish()
+
+
+def _make_tree(target, base, depth, fanout):
+    """Create a tree of directories, each holding fanout files."""
+    dirs = []
+    files = []
+    level = [base]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                path = "%s/d%d" % (parent, i)
+                target.mkdir(path)
+                next_level.append(path)
+                files.append("%s/f%d" % (parent, i))
+                _create_empty(target, files[-1])
+        dirs.extend(level)
+        level = next_level
+    return dirs + level, files
+
+
+def readdir_tree(target, base, recorder, size, count, threads, rng):
+    dirs, _ = _make_tree(target, base, 3, 4)
+    recorder.begin()
+    for i in range(count):
+        recorder.measure(target.readdir, dirs[i % len(dirs)])
+    recorder.finish()
+
+
+def stat_walk(target, base, recorder, size, count, threads, rng):
+    dirs, files = _make_tree(target, base, 3, 4)
+    paths = dirs + files
+    recorder.begin()
+    for i in range(count):
+        recorder.measure(target.getattr, paths[i % len(paths)])
+    recorder.finish()
+
+
+def _create_write(target, path, buf):
+    fh = target.create(path)
+    try:
+        target.write(path, buf, 0, fh)
+    finally:
+        target.release(path, fh)
+
+
+def concurrent_create(target, base, recorder, size, count, threads, rng):
+    buf = "x" * size
+
+    def worker(n):
+        for i in range(n, count, threads):
+            recorder.measure(_create_write, target, "%s/f%d" % (base, i), buf)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    recorder.begin()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    recorder.finish()
+
+
+# Maps workload name to function, and whether it is run for each size.
+WORKLOADS = [
+    ("seq-write", seq_write, True),
+    ("seq-read", seq_read, True),
+    ("rand-write", rand_write, True),
+    ("rand-read", rand_read, True),
+    ("create-unlink", create_unlink, False),
+    ("readdir-tree", readdir_tree, False),
+    ("stat-walk", stat_walk, False),
+    ("concurrent-create", concurrent_create, False),
+]
+
+
+# Filesystem setup
+# ================
+
+
+class DirectFS(object):
+    """Context manager providing a DirectTarget for a filesystem."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.client = None
+        self.fs = None
+        self.root = None
+        self.target = None
+
+    def __enter__(self):
+        module = _load(self.name)
+        if self.name == "passthrough":
+            self.root = tempfile.mkdtemp(prefix="fuse-bench-")
+            self.fs = module.Passthrough(self.root)
+        else:
+            if not self.args.real_etcd:
+                self.client = fake_etcd.client(latency=self.args.latency)
+            if self.name == "etcd":
+                self.fs = module.EtcdFS(client=self.client)
+            else:
+                self.fs = module.EtcdFSV2(client=self.client,
+                                          writeback=self.args.writeback)
+                self.fs.init("/")
+        self.target = DirectTarget(self.fs)
+        return self
+
+    def __exit__(self, *args):
+        if self.name == "etcd-v2":
+            self.fs.destroy("/")
+        if self.root:
+            shutil.rmtree(self.root)
+
+    def rpcs(self):
+        if self.client is None:
+            return None
+        return sum(self.client.rpcs.values())
+
+
+class MountedFS(object):
+    """Context manager providing a MountTarget for a filesystem."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.root = None
+        self.process = None
+        self.target = None
+
+    def __enter__(self):
+        script = os.path.join(ROOT, FILESYSTEMS[self.name])
+        mountpoint = self.args.mountpoint
+        command = [sys.executable, script]
+        if self.name == "passthrough":
+            self.root = tempfile.mkdtemp(prefix="fuse-bench-")
+            command += [self.root, mountpoint]
+        else:
+            command.append(mountpoint)
+        if self.name == "etcd-v2":
+            command += ["--threads", "--log-level", "WARNING"]
+            if self.args.writeback:
+                command.append("--writeback")
+            if not self.args.real_etcd:
+                command += ["--fake-etcd",
+                            "--fake-etcd-latency", str(self.args.latency)]
+        self.process = subprocess.Popen(command,
+                                        cwd=os.path.dirname(script))
+        deadline = time.time() + 30
+        while not os.path.ismount(mountpoint):
+            if self.process.poll() is not None or time.time() > deadline:
+                raise Exception("Failed to mount %s" % self.name)
+            time.sleep(0.1)
+        self.target = MountTarget(mountpoint)
+        return self
+
+    def __exit__(self, *args):
+        subprocess.call(["fusermount", "-u", self.args.mountpoint])
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        if self.root:
+            shutil.rmtree(self.root)
+
+    def rpcs(self):
+        # The filesystem's etcd client is in another process.
+        return None
+
+
+def run_workload(fs, workload, size, args):
+    name, func, _ = workload
+    # Use a fresh directory, so that runs against a shared etcd do not
+    # collide.
+    base = "/bench-%s" % uuid.uuid4().hex[:8]
+    fs.target.mkdir(base)
+    recorder = Recorder(fs.rpcs)
+    func(fs.target, base, recorder, size, args.count, args.threads,
+         random.Random(args.seed))
+
+    ops = len(recorder.latencies)
+    rpcs = None
+    if recorder.rpcs_start is not None and ops:
+        rpcs = (recorder.rpcs_end - recorder.rpcs_start) / float(ops)
+    elapsed = recorder.end - recorder.start
+    return {
+        "workload": name,
+        "size": size,
+        "ops": ops,
+        "errors": recorder.errors,
+        "seconds": elapsed,
+        "ops_per_sec": ops / elapsed if elapsed else 0,
+        "mean": sum(recorder.latencies) / ops if ops else 0,
+        "p50": _percentile(recorder.latencies, 50),
+        "p99": _percentile(recorder.latencies, 99),
+        "rpcs_per_op": rpcs,
+    }
+
+
+def run(args):
+    results = []
+    workloads = [w for w in WORKLOADS if w[0] in args.workloads]
+    for mode in args.modes:
+        for name in args.filesystems:
+            if mode == MODE_MOUNT and name == "etcd" and not args.real_etcd:
+                logging.warning("Skipping mounted etcd: it cannot use the "
+                                "in-memory etcd stand-in")
+                continue
+            fs_class = DirectFS if mode == MODE_DIRECT else MountedFS
+            with fs_class(name, args) as fs:
+                for workload in workloads:
+                    sizes = args.sizes if workload[2] else [args.sizes[0]]
+                    for size in sizes:
+                        result = run_workload(fs, workload, size, args)
+                        result.update({"filesystem": name, "mode": mode})
+                        results.append(result)
+                        _print_result(result)
+    return results
+
+
+def _print_result(result):
+    sys.stderr.write(
+        "%-12s %-7s %-18s %8s %7d ops %6d err %10.1f ops/s "
+        "p50 %8.3fms p99 %8.3fms rpcs/op %s\n" % (
+            result["filesystem"], result["mode"], result["workload"],
+            result["size"], result["ops"], result["errors"],
+            result["ops_per_sec"], result["p50"] * 1000,
+            result["p99"] * 1000,
+            "%.2f" % result["rpcs_per_op"]
+            if result["rpcs_per_op"] is not None else "-"))
+
+
+def _result_key(result):
+    return (result["filesystem"], result["mode"], result["workload"],
+            result["size"])
+
+
+def compare(baseline, results, threshold):
+    """Print changes in throughput since a baseline run.
+
+    Return the number of results whose throughput fell by more than
+    threshold percent.
+    """
+    previous = dict((_result_key(r), r) for r in baseline["results"])
+    regressions = 0
+    for result in results:
+        old = previous.get(_result_key(result))
+        if not old or not old["ops_per_sec"]:
+            continue
+        change = (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100
+        regressed = change < -threshold
+        regressions += regressed
+        sys.stderr.write("%-12s %-7s %-18s %8s %+7.1f%%%s\n" % (
+            _result_key(result) + (change, " REGRESSION" if regressed
+                                   else "")))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the FUSE filesystems")
+    parser.add_argument("--filesystems", nargs="+", choices=sorted(FILESYSTEMS),
+                        default=sorted(FILESYSTEMS))
+    parser.add_argument("--modes", nargs="+", choices=MODES,
+                        default=[MODE_DIRECT],
+                        help="call filesystem methods directly, or through "
+                             "a mount at --mountpoint")
+    parser.add_argument("--workloads", nargs="+",
+                        choices=[w[0] for w in WORKLOADS],
+                        default=[w[0] for w in WORKLOADS])
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[4096, 65536, 1024 * 1024],
+                        help="operation sizes in bytes for read and write "
+                             "workloads")
+    parser.add_argument("--count", type=int, default=100,
+                        help="number of operations per workload")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of writers in concurrent workloads")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for random offsets")
+    parser.add_argument("--real-etcd", action="store_true",
+                        help="use the etcd server used by the filesystems "
+                             "rather than an in-memory stand-in")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds of latency added to each request to "
+                             "the in-memory etcd stand-in")
+    parser.add_argument("--writeback", action="store_true",
+                        help="enable write-back buffering in etcd-v2")
+    parser.add_argument("--mountpoint", default="/mnt/bench")
+    parser.add_argument("--output",
+                        help="file to write JSON results to, rather than "
+                             "standard output")
+    parser.add_argument("--compare",
+                        help="JSON results of a previous run to compare "
+                             "throughput against")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percentage fall in throughput reported as a "
+                             "regression by --compare")
+    return parser.parse_args()
+
+
+def main(args):
+    results = run(args)
+    config = dict((key, value) for key, value in vars(args).items()
+                  if key not in ("output", "compare", "threshold"))
+    output = {"config": config, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,117 @@
+"""Coalescing of single key reads made by concurrent threads.
+
+Each read is queued, and the first waiting thread which finds fewer than
+`max_in_flight` batches in flight sends every queued read, up to
+`max_batch`, as a single etcd transaction on behalf of the others. While
+requests are in flight, new reads queue up and are sent together when one
+completes, so under parallel load many reads share a round-trip, while an
+uncontended read is sent immediately.
+"""
+
+import threading
+import time
+
+import etcdclient
+
+
+# etcd limits a transaction to 128 operations by default.
+MAX_BATCH = 128
+
+# Default number of batches which may be in flight at once.
+MAX_IN_FLIGHT = 4
+
+
+class _Read(object):
+
+    __slots__ = ('key', 'revision', 'sent', 'done', 'response', 'error')
+
+    def __init__(self, key, revision):
+        self.key = key
+        self.revision = revision
+        self.sent = False
+        self.done = False
+        self.response = None
+        self.error = None
+
+
+class Batcher(object):
+    """Sends reads of single keys from many threads in batches.
+
+    If `window` is set, a thread which is about to send a batch first waits
+    this many seconds for more reads to be queued, bounding the latency added
+    to each read.
+    """
+
+    def __init__(self, client, window=0, max_batch=MAX_BATCH,
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self.cond = threading.Condition()
+        self.queue = []
+        self.in_flight = 0
+
+    def get_response(self, key, revision=None):
+        """Read a key at a revision, or the latest revision if None.
+
+        Returns a RangeResponse, as etcdclient.get_range_response does.
+        """
+        read = _Read(key, revision)
+        with self.cond:
+            self.queue.append(read)
+            while not read.done:
+                if not read.sent and self.in_flight < self.max_in_flight:
+                    self._send()
+                else:
+                    self.cond.wait()
+        if read.error is not None:
+            raise read.error
+        return read.response
+
+    def _send(self):
+        """Send queued reads as one batch. Called with the lock held."""
+        self.in_flight += 1
+        if self.window:
+            self.cond.release()
+            try:
+                time.sleep(self.window)
+            finally:
+                self.cond.acquire()
+        batch = self.queue[:self.max_batch]
+        del self.queue[:self.max_batch]
+        for read in batch:
+            read.sent = True
+        self.cond.release()
+        try:
+            self._read(batch)
+        finally:
+            self.cond.acquire()
+            for read in batch:
+                read.done = True
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def _read(self, batch):
+        if len(batch) == 1:
+            requests = None
+        else:
+            requests = [dict(key=read.key, revision=read.revision)
+                        for read in batch]
+        try:
+            if requests is not None:
+                responses = etcdclient.get_batch_responses(self.client,
+                                                           requests)
+                for read, response in zip(batch, responses):
+                    read.response = response
+                return
+        except Exception:
+            # One bad read, such as of a compacted revision, fails the whole
+            # transaction, so fall back to reading each key separately.
+            pass
+        for read in batch:
+            try:
+                read.response = etcdclient.get_range_response(
+                    self.client, read.key, revision=read.revision)
+            except Exception as e:
+                read.error = e
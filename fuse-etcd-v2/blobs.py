@@ -0,0 +1,215 @@
+"""Content addressed storage of file data blocks.
+
+Each distinct block of data is stored once, under the SHA-256 digest of its
+content (blob/<digest>), with a count of the references to it
+(blobref/<digest>). Files hold only the digests of their blocks. A blob is
+removed when the last reference to it is released.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+import uuid
+
+import etcdclient
+import stm
+
+
+LOG = logging.getLogger(__name__)
+
+BLOB_PREFIX = "blob/"
+REF_PREFIX = "blobref/"
+# References released by removing or truncating a file are queued under this
+# prefix, and released in batches by later transactions.
+GC_PREFIX = "gc/"
+
+# Maximum number of references released by one transaction. Releasing the
+# last reference to a blob takes two operations, and etcd limits a
+# transaction to 128 operations by default.
+GC_BATCH = 40
+
+
+def get_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class BlobStore(object):
+    """Reads and reference counts blobs stored in etcd.
+
+    Blobs are immutable, so they are cached in memory without needing to be
+    invalidated. The cache is bounded by the total size of cached blobs, with
+    least recently used blobs evicted first. Blobs are stored as returned by
+    encode, and cached as returned by decode.
+    """
+
+    def __init__(self, client, cache_size, get_stm, encode, decode):
+        self.client = client
+        self.cache_size = cache_size
+        # Returns a new STM, for releasing queued references.
+        self.get_stm = get_stm
+        self.encode = encode
+        self.decode = decode
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+
+    def _cache(self, digest, content):
+        with self.lock:
+            if digest in self.cache or len(content) > self.cache_size:
+                return
+            self.cache[digest] = content
+            self.cached_bytes += len(content)
+            while self.cached_bytes > self.cache_size:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+
+    def get(self, digests):
+        """Return a dict mapping each digest to the content of its blob.
+
+        Blobs which are not cached are read in a single request. If a blob
+        does not exist, the references to it which were read must be stale,
+        so stm.Conflict is raised for the transaction to be retried.
+        """
+        blobs = {}
+        missing = []
+        with self.lock:
+            for digest in set(digests):
+                content = self.cache.pop(digest, None)
+                if content is None:
+                    missing.append(digest)
+                else:
+                    # Mark as most recently used.
+                    self.cache[digest] = content
+                    blobs[digest] = content
+        if not missing:
+            return blobs
+        txn = self.client.transactions
+        _, responses = self.client.transaction(
+            compare=[],
+            success=[txn.get(BLOB_PREFIX + digest) for digest in missing],
+            failure=[])
+        for digest, response in zip(missing, responses):
+            for value, _ in response:
+                content = self.decode(value)
+                blobs[digest] = content
+                self._cache(digest, content)
+        lost = [BLOB_PREFIX + digest for digest in missing
+                if digest not in blobs]
+        if lost:
+            raise stm.Conflict(lost)
+        return blobs
+
+    def get_digests(self, s, start, end):
+        """Return the digests held by the block keys in [start, end).
+
+        The keys are read with a single range request, at the revision of
+        the STM if it has one, but are not added to its read set. This is
+        safe because a file's blocks are only changed along with its
+        metadata, which the caller must have read through the STM.
+        """
+        response = etcdclient.get_range_response(self.client, start, end,
+                                                 revision=s.revision)
+        return [kv.value for kv in response.kvs]
+
+    def enqueue(self, s, digests):
+        """Queue references for release once an STM commits.
+
+        Returns the key of the queue, to be passed to collect after the
+        commit, or None if there is nothing to release. If the references
+        are not released, for example because the mount stops, they are
+        released by the next mount.
+        """
+        if not digests:
+            return None
+        key = GC_PREFIX + uuid.uuid4().hex
+        s.put(key, "\n".join(digests))
+        return key
+
+    def collect(self, key):
+        """Release the references queued under a key."""
+        more = True
+        while more:
+            s = self.get_stm()
+
+            @s.retried_transaction(prefetch_keys=[key])
+            def _collect(s):
+                value = s.get(key)
+                if not value:
+                    return False
+                digests = value.split("\n")
+                changes = Changes(self)
+                changes.release(digests[:GC_BATCH])
+                changes.apply(s)
+                if len(digests) > GC_BATCH:
+                    s.put(key, "\n".join(digests[GC_BATCH:]))
+                    return True
+                s.delete(key)
+                return False
+
+            more = _collect()
+
+    def collect_all(self):
+        """Release references queued by any mount, but not yet released."""
+        for _, kv in self.client.get_prefix(GC_PREFIX, keys_only=True):
+            LOG.info("Releasing queued blob references %s", kv.key)
+            self.collect(kv.key)
+
+
+class Changes(object):
+    """Changes to blob references made within one transaction.
+
+    Reference counts are updated by apply, which reads the count of every
+    blob referenced or released with a single request.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # Maps digest to change in reference count.
+        self.refs = collections.Counter()
+        # Content of blobs referenced, in case they do not yet exist.
+        self.blobs = {}
+
+    def get_block(self, s, block_key):
+        """Return the content of a block, or None if it is a hole."""
+        digest = s.get(block_key)
+        if digest is None:
+            return None
+        return self.store.get([digest])[digest]
+
+    def put_block(self, s, block_key, content):
+        """Store content in a block, replacing any existing content."""
+        digest = get_digest(content)
+        old = s.get(block_key)
+        if old == digest:
+            return
+        if old is not None:
+            self.refs[old] -= 1
+        self.refs[digest] += 1
+        self.blobs[digest] = content
+        # The content of a digest never changes, so it may be cached even if
+        # the transaction fails.
+        self.store._cache(digest, content)
+        s.put(block_key, digest)
+
+    def release(self, digests):
+        for digest in digests:
+            self.refs[digest] -= 1
+
+    def apply(self, s):
+        digests = sorted(digest for digest, delta in self.refs.items()
+                         if delta)
+        s.prefetch([REF_PREFIX + digest for digest in digests])
+        for digest in digests:
+            delta = self.refs[digest]
+            ref_key = REF_PREFIX + digest
+            count = int(s.get(ref_key) or 0)
+            if count + delta > 0:
+                if not count:
+                    s.put(BLOB_PREFIX + digest,
+                          self.store.encode(self.blobs[digest]))
+                s.put(ref_key, str(count + delta))
+            elif count:
+                s.delete(ref_key)
+                s.delete(BLOB_PREFIX + digest)
+        self.refs.clear()
@@ -0,0 +1,149 @@
+import collections
+import logging
+import threading
+import time
+
+import etcd3
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WatchedCache(object):
+    """LRU cache of decoded etcd values, kept coherent using a watch.
+
+    Entries are keyed by etcd key and tagged with the mod_revision of the
+    value they hold. A background thread watches the cached key prefix and
+    applies every change to the cache, so that changes made by other clients
+    are seen promptly. Deletions are recorded as tombstones, so that a slow
+    reader cannot cache a value which has since been deleted.
+
+    The cache is only used while the watch is established. If the watch
+    fails, the cache is cleared and bypassed until it has been re-established.
+    """
+
+    def __init__(self, client, prefix, size, decode):
+        self.client = client
+        self.prefix = prefix
+        self.size = size
+        self.decode = decode
+        self.lock = threading.Lock()
+        # Maps key to (value, mod_revision). A value of None is a tombstone.
+        self.entries = collections.OrderedDict()
+        # Revision up to which watch events have been applied, or None if
+        # the watch is not established.
+        self.revision = None
+        # Highest mod_revision of any entry evicted from the cache.
+        self.evicted_revision = 0
+        self.cancel = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if not self.size:
+            return
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.cancel:
+            self.cancel()
+        if self.thread:
+            self.thread.join(1)
+
+    def is_active(self):
+        """Return whether the cache is in use, which requires the watch."""
+        return self.revision is not None
+
+    def get(self, key):
+        """Return the cached value for a key, or None on a miss."""
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        """Return the cached (value, mod_revision) for a key, or None.
+
+        A value of None means that the key was deleted at mod_revision.
+        """
+        with self.lock:
+            if self.revision is None:
+                return None
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # Mark as most recently used.
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, value, mod_revision, read_revision):
+        """Cache a decoded value read from etcd.
+
+        mod_revision is the revision at which the value was last modified,
+        and read_revision is the revision at which it was read. A key which
+        does not exist is cached as a tombstone by passing a value of None,
+        with read_revision as its mod_revision.
+        """
+        with self.lock:
+            if self.revision is None:
+                return
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] >= mod_revision:
+                    return
+            elif (read_revision < self.revision and
+                    self.evicted_revision > read_revision):
+                # The key may have been modified since it was read, and the
+                # change evicted from the cache.
+                return
+            self._set(key, value, mod_revision)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _set(self, key, value, mod_revision):
+        self.entries.pop(key, None)
+        self.entries[key] = value, mod_revision
+        while len(self.entries) > self.size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.evicted_revision = max(self.evicted_revision, evicted)
+
+    def _apply(self, event):
+        with self.lock:
+            entry = self.entries.get(event.key)
+            if entry is None or entry[1] < event.mod_revision:
+                if isinstance(event, etcd3.events.DeleteEvent):
+                    value = None
+                else:
+                    value = self.decode(event.value)
+                self._set(event.key, value, event.mod_revision)
+            self.revision = max(self.revision, event.mod_revision)
+
+    def _watch(self):
+        while not self.stopped.is_set():
+            try:
+                # Start watching from the current revision, so that no change
+                # after this point can be missed. A stale revision only means
+                # replaying more changes, so any member may serve this read.
+                response = self.client.get_response(self.prefix,
+                                                    serializable=True)
+                revision = response.header.revision
+                events, self.cancel = self.client.watch_prefix(
+                    self.prefix, start_revision=revision + 1)
+                with self.lock:
+                    self.revision = revision
+                for event in events:
+                    self._apply(event)
+            except Exception:
+                LOG.exception("Watch on %s failed", self.prefix)
+            with self.lock:
+                self.revision = None
+                self.entries.clear()
+            if not self.stopped.is_set():
+                time.sleep(1)
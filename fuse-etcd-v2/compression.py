@@ -0,0 +1,61 @@
+"""Compression of stored file data.
+
+Each stored value starts with a header byte identifying the codec used to
+compress it, so values written with different codecs, for example by mounts
+with different options, can all be read. Values which do not compress are
+stored uncompressed.
+
+zlib is always available. lz4 is available if the lz4 package is installed.
+"""
+
+import zlib
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+
+NONE = "none"
+ZLIB = "zlib"
+LZ4 = "lz4"
+
+
+class Codec(object):
+
+    def __init__(self, name, header, compress, decompress):
+        self.name = name
+        self.header = header
+        self.compress = compress
+        self.decompress = decompress
+
+
+_CODECS = [
+    Codec(NONE, "\x00", lambda data: data, lambda data: data),
+    Codec(ZLIB, "\x01", zlib.compress, zlib.decompress),
+]
+if lz4 is not None:
+    _CODECS.append(Codec(LZ4, "\x02", lz4.block.compress,
+                         lz4.block.decompress))
+
+CODECS = dict((codec.name, codec) for codec in _CODECS)
+_CODECS_BY_HEADER = dict((codec.header, codec) for codec in _CODECS)
+
+
+def encode(data, codec=NONE):
+    """Return data compressed with a codec, prefixed by a header byte."""
+    codec = CODECS[codec]
+    if codec.name != NONE:
+        compressed = codec.compress(data)
+        if len(compressed) < len(data):
+            return codec.header + compressed
+        codec = CODECS[NONE]
+    return codec.header + data
+
+
+def decode(value):
+    """Return the data held by a value returned by encode."""
+    codec = _CODECS_BY_HEADER.get(value[:1])
+    if codec is None:
+        raise ValueError("Unknown compression header %r" % value[:1])
+    return codec.decompress(value[1:])
@@ -0,0 +1,268 @@
+"""Helpers for etcd requests which the etcd3 client does not fully support.
+
+The range methods of etcd3 (as of 0.12) accept `limit` and `revision`
+arguments, but do not set them in the request, so these helpers build and
+send range requests directly. Clients which are not gRPC based, such as an
+in-memory stand-in, are called through their `get_range_response` method.
+"""
+
+from etcd3.client import _handle_errors
+import etcd3.etcdrpc as etcdrpc
+import grpc
+
+
+def _is_grpc(client):
+    return hasattr(client, 'kvstub')
+
+
+def _build_range_request(client, key, range_end=None, revision=None,
+                         limit=None, **kwargs):
+    request = client._build_get_range_request(key, range_end=range_end,
+                                              **kwargs)
+    if revision:
+        request.revision = revision
+    if limit:
+        request.limit = limit
+    return request
+
+
+@_handle_errors
+def get_range_response(client, key, range_end=None, **kwargs):
+    """Perform a range request, and return the RangeResponse.
+
+    If range_end is None, only key is read. Keyword arguments are those of
+    etcd's RangeRequest, including revision and limit.
+    """
+    if not _is_grpc(client):
+        return client.get_range_response(key, range_end, **kwargs)
+    request = _build_range_request(client, key, range_end, **kwargs)
+    return client.kvstub.Range(request, client.timeout,
+                               credentials=client.call_credentials,
+                               metadata=client.metadata)
+
+
+@_handle_errors
+def get_many_responses(client, keys, **kwargs):
+    """Read several keys, and return a RangeResponse for each.
+
+    With a gRPC client, all requests are sent before waiting for any
+    response, so reading any number of keys takes about one round-trip.
+    """
+    if not _is_grpc(client):
+        return [client.get_range_response(key, None, **kwargs)
+                for key in keys]
+    futures = [
+        client.kvstub.Range.future(
+            _build_range_request(client, key, **kwargs), client.timeout,
+            credentials=client.call_credentials, metadata=client.metadata)
+        for key in keys
+    ]
+    return [future.result() for future in futures]
+
+
+@_handle_errors
+def get_batch_responses(client, requests):
+    """Perform several range requests in a single transaction.
+
+    requests is a list of keyword arguments of get_range_response, each
+    including key. Returns a RangeResponse for each, all with the header of
+    the transaction.
+    """
+    if not _is_grpc(client):
+        return client.get_range_responses(requests)
+    txn_request = etcdrpc.TxnRequest(
+        compare=[],
+        success=[etcdrpc.RequestOp(
+                     request_range=_build_range_request(client, **request))
+                 for request in requests],
+        failure=[])
+    txn_response = client.kvstub.Txn(txn_request, client.timeout,
+                                     credentials=client.call_credentials,
+                                     metadata=client.metadata)
+    responses = []
+    for response_op in txn_response.responses:
+        response = response_op.response_range
+        response.header.CopyFrom(txn_response.header)
+        responses.append(response)
+    return responses
+
+
+def iter_range_responses(client, key, range_end, batch_size, revision=None,
+                         **kwargs):
+    """Read [key, range_end) batch_size keys at a time.
+
+    Yields the RangeResponse of each batch as it arrives. Batches after the
+    first are read at the revision of the first, so together they are a
+    consistent snapshot.
+    """
+    while True:
+        response = get_range_response(client, key, range_end,
+                                      revision=revision, limit=batch_size,
+                                      **kwargs)
+        yield response
+        if not response.more or not response.kvs:
+            return
+        revision = revision or response.header.revision
+        # Continue from the key after the last one read.
+        key = response.kvs[-1].key + b'\0'
+
+
+def iter_range(client, key, range_end, batch_size, **kwargs):
+    """Yield the KeyValues in [key, range_end), reading batch_size at a time.
+
+    See iter_range_responses.
+    """
+    for response in iter_range_responses(client, key, range_end, batch_size,
+                                         **kwargs):
+        for kv in response.kvs:
+            yield kv
+
+
+class _InstrumentedFuture(object):
+
+    def __init__(self, future, method, bytes_sent, record_rpc):
+        self.future = future
+        self.method = method
+        self.bytes_sent = bytes_sent
+        self.record_rpc = record_rpc
+
+    def result(self, *args, **kwargs):
+        response = self.future.result(*args, **kwargs)
+        # Recorded here rather than on completion, so that the request is
+        # attributed to the waiting thread.
+        self.record_rpc(self.method, self.bytes_sent, response.ByteSize())
+        return response
+
+
+class _InstrumentedMethod(object):
+
+    def __init__(self, method, name, record_rpc):
+        self.method = method
+        self.name = name
+        self.record_rpc = record_rpc
+
+    def __call__(self, request, *args, **kwargs):
+        response = self.method(request, *args, **kwargs)
+        self.record_rpc(self.name, request.ByteSize(), response.ByteSize())
+        return response
+
+    def future(self, request, *args, **kwargs):
+        future = self.method.future(request, *args, **kwargs)
+        return _InstrumentedFuture(future, self.name, request.ByteSize(),
+                                   self.record_rpc)
+
+
+class _CountedRequests(object):
+    """Iterator over a stream of request messages, counting bytes sent."""
+
+    def __init__(self, requests):
+        self.requests = iter(requests)
+        self.bytes_sent = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        request = next(self.requests)
+        self.bytes_sent += request.ByteSize()
+        return request
+
+    __next__ = next
+
+    def take_bytes_sent(self):
+        bytes_sent, self.bytes_sent = self.bytes_sent, 0
+        return bytes_sent
+
+
+class _InstrumentedResponses(object):
+    """Iterator over a stream of response messages, recording each."""
+
+    def __init__(self, responses, method, requests, record_rpc):
+        self.responses = responses
+        self.method = method
+        self.requests = requests
+        self.record_rpc = record_rpc
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        response = next(self.responses)
+        self.record_rpc(self.method, self.requests.take_bytes_sent(),
+                        response.ByteSize())
+        return response
+
+    __next__ = next
+
+    def __getattr__(self, name):
+        # The call itself, for example to cancel it.
+        return getattr(self.responses, name)
+
+
+class _InstrumentedStreamMethod(object):
+    """Method which streams requests, responses or both.
+
+    Each response message is recorded as a request, with the size of the
+    request messages sent since the previous response.
+    """
+
+    def __init__(self, method, name, record_rpc, request_streaming,
+                 response_streaming):
+        self.method = method
+        self.name = name
+        self.record_rpc = record_rpc
+        self.request_streaming = request_streaming
+        self.response_streaming = response_streaming
+
+    def __call__(self, request, *args, **kwargs):
+        if self.request_streaming:
+            requests = request = _CountedRequests(request)
+        else:
+            requests = _CountedRequests(())
+            requests.bytes_sent = request.ByteSize()
+        response = self.method(request, *args, **kwargs)
+        if self.response_streaming:
+            return _InstrumentedResponses(response, self.name, requests,
+                                          self.record_rpc)
+        self.record_rpc(self.name, requests.take_bytes_sent(),
+                        response.ByteSize())
+        return response
+
+
+class _InstrumentedStub(object):
+
+    def __init__(self, stub, record_rpc):
+        self.stub = stub
+        self.record_rpc = record_rpc
+
+    def __getattr__(self, name):
+        method = getattr(self.stub, name)
+        request_streaming = isinstance(method, (
+            grpc.StreamUnaryMultiCallable, grpc.StreamStreamMultiCallable))
+        response_streaming = isinstance(method, (
+            grpc.UnaryStreamMultiCallable, grpc.StreamStreamMultiCallable))
+        if request_streaming or response_streaming:
+            return _InstrumentedStreamMethod(method, name, self.record_rpc,
+                                             request_streaming,
+                                             response_streaming)
+        return _InstrumentedMethod(method, name, self.record_rpc)
+
+
+def instrument(client, record_rpc):
+    """Call record_rpc(method, bytes_sent, bytes_received) for each request.
+
+    Key value and lease requests are recorded, with the encoded sizes of the
+    request and response. Each message received from a streaming method, such
+    as a lease keep-alive, is recorded as a request. Long-lived watch streams
+    are not recorded. With a
+    pool.ClientPool, the requests of every client in the pool are recorded.
+    """
+    if hasattr(client, 'clients'):
+        for member in client.clients:
+            instrument(member, record_rpc)
+        return
+    if not _is_grpc(client):
+        client.record_rpc = record_rpc
+        return
+    client.kvstub = _InstrumentedStub(client.kvstub, record_rpc)
+    client.leasestub = _InstrumentedStub(client.leasestub, record_rpc)
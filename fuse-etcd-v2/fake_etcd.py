@@ -0,0 +1,582 @@
+"""In-memory stand-in for the subset of the etcd3 client used by ffs.
+
+This implements enough of `etcd3.Etcd3Client` for the filesystems and the STM
+to run without an etcd server: single key and range reads
+(optionally at a past revision), puts, deletes, transactions with value,
+version, create and mod compares, watches, leases and locks. Every write
+bumps a global revision as etcd does, and old revisions are retained so that
+revision-pinned reads and watches from a start revision behave as they would
+against a real cluster.
+
+An optional `latency` (in seconds) is slept on every RPC to emulate the
+network round-trip, and every RPC is counted in `rpcs` so that callers can
+measure round-trips per operation.
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+from etcd3 import events
+from etcd3 import exceptions
+from etcd3 import leases
+from etcd3 import locks
+from etcd3 import transactions
+from etcd3.client import Transactions
+import etcd3.etcdrpc as etcdrpc
+
+
+# Default limits of etcd, which are enforced so that tests catch requests
+# which a real cluster would reject.
+MAX_TXN_OPS = 128
+MAX_REQUEST_BYTES = 1536 * 1024
+
+
+class Header(object):
+
+    def __init__(self, revision):
+        self.revision = revision
+
+
+class KeyValue(object):
+    """A single version of a key, as stored in the MVCC history."""
+
+    def __init__(self, key, value, create_revision, mod_revision, version,
+                 lease=0):
+        self.key = key
+        self.value = value
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
+        self.lease = lease
+
+
+class KVMetadata(object):
+    """Mirror of `etcd3.client.KVMetadata`."""
+
+    def __init__(self, kv, header):
+        self.key = kv.key
+        self.create_revision = kv.create_revision
+        self.mod_revision = kv.mod_revision
+        self.version = kv.version
+        self.lease_id = kv.lease
+        self.response_header = header
+
+
+class RangeResponse(object):
+
+    def __init__(self, header, kvs, count, more):
+        self.header = header
+        self.kvs = kvs
+        self.count = count
+        self.more = more
+
+
+class _RawEvent(object):
+    """Shape of a gRPC watch event, as wrapped by `etcd3.events`."""
+
+    def __init__(self, kv, prev_kv):
+        self.kv = kv
+        self.prev_kv = prev_kv
+
+
+class _ResponseOp(object):
+    """Mirror of a put or delete ResponseOp, in which unset fields are empty."""
+
+    def __init__(self, response_put=None, response_delete_range=None):
+        self.response_put = response_put or _PutResponse(Header(0))
+        self.response_delete_range = (response_delete_range or
+                                      _DeleteResponse(Header(0), 0))
+
+
+class _PutResponse(object):
+
+    def __init__(self, header):
+        self.header = header
+
+
+class _DeleteResponse(object):
+
+    def __init__(self, header, deleted):
+        self.header = header
+        self.deleted = deleted
+
+
+class _LeaseInfo(object):
+
+    def __init__(self, ttl, granted_ttl, keys):
+        self.TTL = ttl
+        self.grantedTTL = granted_ttl
+        self.keys = keys
+
+
+class _Lease(object):
+
+    def __init__(self, lease_id, ttl):
+        self.id = lease_id
+        self.ttl = ttl
+        self.deadline = time.time() + ttl
+        self.keys = set()
+
+
+class FakeEtcd(object):
+    """In-memory etcd with real revision semantics."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.transactions = Transactions()
+        self.rpcs = collections.Counter()
+        # If set, called as with etcdclient.instrument for every RPC. Sizes
+        # are not measured, and are recorded as zero.
+        self.record_rpc = None
+        self._cond = threading.Condition(threading.RLock())
+        self._revision = 1
+        # key -> list of KeyValue, oldest first. A deleted key is recorded
+        # as a KeyValue with a value of None.
+        self._history = {}
+        # All events in revision order, for watches.
+        self._events = []
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+
+    # Helpers
+    # =======
+
+    def _rpc(self, name):
+        self.rpcs[name] += 1
+        if self.record_rpc:
+            self.record_rpc(name, 0, 0)
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def revision(self):
+        return self._revision
+
+    def _header(self):
+        return Header(self._revision)
+
+    def _current(self, key, revision=None):
+        """Return the live KeyValue for a key at a revision, or None."""
+        versions = self._history.get(key)
+        if not versions:
+            return None
+        if revision is None:
+            kv = versions[-1]
+        else:
+            kv = None
+            for candidate in reversed(versions):
+                if candidate.mod_revision <= revision:
+                    kv = candidate
+                    break
+        if kv is None or kv.value is None:
+            return None
+        return kv
+
+    @staticmethod
+    def _in_range(key, range_start, range_end):
+        if range_end is None:
+            return key == range_start
+        if range_end == b'\0':
+            return key >= range_start
+        return range_start <= key < range_end
+
+    def _range(self, key, range_end=None, revision=None):
+        if revision is not None and revision > self._revision:
+            raise exceptions.Etcd3Exception("future revision")
+        if range_end is None:
+            kv = self._current(key, revision)
+            return [kv] if kv is not None else []
+        kvs = []
+        for k in sorted(self._history):
+            if self._in_range(k, key, range_end):
+                kv = self._current(k, revision)
+                if kv is not None:
+                    kvs.append(kv)
+        return kvs
+
+    def _expire_leases(self):
+        now = time.time()
+        expired = [lease for lease in self._leases.values()
+                   if lease.deadline <= now]
+        for lease in expired:
+            self._revoke(lease.id)
+
+    def _revoke(self, lease_id):
+        lease = self._leases.pop(lease_id, None)
+        if lease is None:
+            return
+        live = [key for key in lease.keys if self._current(key) is not None]
+        if live:
+            self._revision += 1
+            for key in live:
+                self._do_delete(key)
+            self._cond.notify_all()
+
+    def _do_put(self, key, value, lease=None):
+        """Apply a put at the current (already bumped) revision."""
+        lease_id = self._lease_id(lease)
+        prev = self._current(key)
+        if prev is None:
+            kv = KeyValue(key, value, self._revision, self._revision, 1,
+                          lease_id)
+        else:
+            if prev.lease and prev.lease in self._leases:
+                self._leases[prev.lease].keys.discard(key)
+            kv = KeyValue(key, value, prev.create_revision, self._revision,
+                          prev.version + 1, lease_id)
+        if lease_id:
+            self._leases[lease_id].keys.add(key)
+        self._history.setdefault(key, []).append(kv)
+        self._events.append(events.PutEvent(_RawEvent(kv, prev)))
+
+    def _do_delete(self, key):
+        prev = self._current(key)
+        if prev is None:
+            return 0
+        tombstone = KeyValue(key, None, 0, self._revision, 0)
+        self._history[key].append(tombstone)
+        self._events.append(events.DeleteEvent(_RawEvent(
+            KeyValue(key, b'', 0, self._revision, 0), prev)))
+        return 1
+
+    def _lease_id(self, lease):
+        if lease is None:
+            return 0
+        lease_id = getattr(lease, 'id', lease)
+        if lease_id not in self._leases:
+            raise exceptions.Etcd3Exception("lease not found")
+        return lease_id
+
+    def _compare(self, compare):
+        kv = self._current(compare.key)
+        if isinstance(compare, transactions.Value):
+            if kv is None:
+                return False
+            actual = kv.value
+        elif isinstance(compare, transactions.Version):
+            actual = kv.version if kv else 0
+        elif isinstance(compare, transactions.Create):
+            actual = kv.create_revision if kv else 0
+        elif isinstance(compare, transactions.Mod):
+            actual = kv.mod_revision if kv else 0
+        else:
+            raise NotImplementedError(compare)
+        expected = compare.value
+        if compare.op == etcdrpc.Compare.EQUAL:
+            return actual == expected
+        if compare.op == etcdrpc.Compare.NOT_EQUAL:
+            return actual != expected
+        if compare.op == etcdrpc.Compare.LESS:
+            return actual < expected
+        if compare.op == etcdrpc.Compare.GREATER:
+            return actual > expected
+        raise ValueError('op must be one of =, !=, < or >')
+
+    # KV API
+    # ======
+
+    def get_response(self, key, serializable=False):
+        return self.get_range_response(key, None)
+
+    def get(self, key, **kwargs):
+        response = self.get_response(key, **kwargs)
+        if response.count < 1:
+            return None, None
+        kv = response.kvs[-1]
+        return kv.value, KVMetadata(kv, response.header)
+
+    def get_range_response(self, range_start, range_end, sort_order=None,
+                           sort_target='key', limit=None, revision=None,
+                           keys_only=False, serializable=False, **kwargs):
+        self._rpc('range')
+        return self._range_response(range_start, range_end, sort_order,
+                                    limit, revision, keys_only)
+
+    def get_range_responses(self, requests):
+        """Perform several range requests in a single transaction.
+
+        Used by etcdclient.get_batch_responses in place of a gRPC Txn.
+        """
+        self._rpc('txn')
+        with self._cond:
+            return [self._range_response(request['key'],
+                                         request.get('range_end'),
+                                         request.get('sort_order'),
+                                         request.get('limit'),
+                                         request.get('revision'),
+                                         request.get('keys_only', False))
+                    for request in requests]
+
+    def _range_response(self, range_start, range_end, sort_order, limit,
+                        revision, keys_only):
+        with self._cond:
+            self._expire_leases()
+            kvs = self._range(range_start, range_end, revision)
+            if sort_order == 'descend':
+                kvs.reverse()
+            count = len(kvs)
+            more = False
+            if limit and count > limit:
+                kvs = kvs[:limit]
+                more = True
+            if keys_only:
+                kvs = [KeyValue(kv.key, b'', kv.create_revision,
+                                kv.mod_revision, kv.version, kv.lease)
+                       for kv in kvs]
+            return RangeResponse(self._header(), kvs, count, more)
+
+    def get_range(self, range_start, range_end, **kwargs):
+        response = self.get_range_response(range_start, range_end, **kwargs)
+        for kv in response.kvs:
+            yield kv.value, KVMetadata(kv, response.header)
+
+    def get_prefix_response(self, key_prefix, **kwargs):
+        return self.get_range_response(key_prefix, _prefix_end(key_prefix),
+                                       **kwargs)
+
+    def get_prefix(self, key_prefix, **kwargs):
+        response = self.get_prefix_response(key_prefix, **kwargs)
+        return ((kv.value, KVMetadata(kv, response.header))
+                for kv in response.kvs)
+
+    def get_all(self, **kwargs):
+        return self.get_range(b'\0', b'\0', **kwargs)
+
+    def put(self, key, value, lease=None, prev_kv=False):
+        self._rpc('put')
+        with self._cond:
+            self._expire_leases()
+            self._revision += 1
+            self._do_put(key, value, lease)
+            self._cond.notify_all()
+            return _PutResponse(self._header())
+
+    def put_if_not_exists(self, key, value, lease=None):
+        success, _ = self.transaction(
+            compare=[self.transactions.create(key) == 0],
+            success=[self.transactions.put(key, value, lease=lease)],
+            failure=[])
+        return success
+
+    def delete(self, key, prev_kv=False, return_response=False):
+        self._rpc('delete_range')
+        with self._cond:
+            self._expire_leases()
+            if self._current(key) is None:
+                deleted = 0
+            else:
+                self._revision += 1
+                deleted = self._do_delete(key)
+                self._cond.notify_all()
+            response = _DeleteResponse(self._header(), deleted)
+        if return_response:
+            return response
+        return deleted >= 1
+
+    def delete_prefix(self, prefix):
+        self._rpc('delete_range')
+        with self._cond:
+            self._expire_leases()
+            keys = [kv.key for kv in self._range(prefix, _prefix_end(prefix))]
+            if keys:
+                self._revision += 1
+                for key in keys:
+                    self._do_delete(key)
+                self._cond.notify_all()
+            return _DeleteResponse(self._header(), len(keys))
+
+    @staticmethod
+    def _check_txn(compare, success, failure):
+        for ops in (compare, success, failure):
+            if len(ops or []) > MAX_TXN_OPS:
+                raise exceptions.Etcd3Exception(
+                    "etcdserver: too many operations in txn request")
+        size = 0
+        for ops in (compare, success, failure):
+            for op in ops or []:
+                value = getattr(op, 'value', None)
+                size += len(op.key)
+                if isinstance(value, basestring):
+                    size += len(value)
+        if size > MAX_REQUEST_BYTES:
+            raise exceptions.Etcd3Exception("etcdserver: request is too large")
+
+    def transaction(self, compare, success=None, failure=None):
+        self._rpc('txn')
+        self._check_txn(compare, success, failure)
+        with self._cond:
+            self._expire_leases()
+            succeeded = all(self._compare(c) for c in compare)
+            ops = success if succeeded else failure
+            ops = ops or []
+            writes = any(isinstance(op, (transactions.Put,
+                                         transactions.Delete))
+                         for op in ops)
+            if writes:
+                self._revision += 1
+            responses = []
+            for op in ops:
+                if isinstance(op, transactions.Put):
+                    self._do_put(op.key, op.value, op.lease)
+                    responses.append(_ResponseOp(
+                        response_put=_PutResponse(self._header())))
+                elif isinstance(op, transactions.Get):
+                    header = self._header()
+                    responses.append([
+                        (kv.value, KVMetadata(kv, header))
+                        for kv in self._range(op.key, op.range_end)
+                    ])
+                elif isinstance(op, transactions.Delete):
+                    if op.range_end is None:
+                        keys = [op.key]
+                    else:
+                        keys = [kv.key
+                                for kv in self._range(op.key, op.range_end)]
+                    deleted = sum(self._do_delete(key) for key in keys)
+                    responses.append(_ResponseOp(
+                        response_delete_range=_DeleteResponse(
+                            self._header(), deleted)))
+                else:
+                    raise NotImplementedError(op)
+            if writes:
+                self._cond.notify_all()
+            return succeeded, responses
+
+    # Watch API
+    # =========
+
+    def watch_response(self, key, range_end=None, start_revision=None,
+                       **kwargs):
+        self._rpc('watch')
+        cancelled = threading.Event()
+        with self._cond:
+            if start_revision is None:
+                start_revision = self._revision + 1
+            position = [0]
+
+        def cancel():
+            cancelled.set()
+            with self._cond:
+                self._cond.notify_all()
+
+        def iterator():
+            while True:
+                with self._cond:
+                    while True:
+                        if cancelled.is_set():
+                            return
+                        batch = [
+                            e for e in self._events[position[0]:]
+                            if e.mod_revision >= start_revision and
+                            self._in_range(e.key, key, range_end)
+                        ]
+                        position[0] = len(self._events)
+                        if batch:
+                            break
+                        self._cond.wait(0.1)
+                yield _WatchResponse(Header(batch[-1].mod_revision), batch)
+
+        return iterator(), cancel
+
+    def watch(self, key, **kwargs):
+        responses, cancel = self.watch_response(key, **kwargs)
+        return _response_to_event_iterator(responses), cancel
+
+    def watch_prefix_response(self, key_prefix, **kwargs):
+        kwargs['range_end'] = _prefix_end(key_prefix)
+        return self.watch_response(key_prefix, **kwargs)
+
+    def watch_prefix(self, key_prefix, **kwargs):
+        kwargs['range_end'] = _prefix_end(key_prefix)
+        return self.watch(key_prefix, **kwargs)
+
+    def watch_once(self, key, timeout=None, **kwargs):
+        self._rpc('watch')
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            position = len(self._events)
+            while True:
+                for event in self._events[position:]:
+                    if event.key == key:
+                        return event
+                position = len(self._events)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise exceptions.WatchTimedOut()
+                self._cond.wait(remaining)
+
+    # Lease and lock API
+    # ==================
+
+    def lease(self, ttl, lease_id=None):
+        self._rpc('lease_grant')
+        with self._cond:
+            if lease_id is None:
+                lease_id = next(self._lease_ids)
+            self._leases[lease_id] = _Lease(lease_id, ttl)
+        return leases.Lease(lease_id=lease_id, ttl=ttl, etcd_client=self)
+
+    def revoke_lease(self, lease_id):
+        self._rpc('lease_revoke')
+        with self._cond:
+            self._revoke(lease_id)
+
+    def refresh_lease(self, lease_id):
+        self._rpc('lease_keepalive')
+        with self._cond:
+            self._expire_leases()
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                ttl = 0
+            else:
+                lease.deadline = time.time() + lease.ttl
+                ttl = lease.ttl
+        yield _LeaseInfo(ttl, ttl, [])
+
+    def get_lease_info(self, lease_id):
+        self._rpc('lease_ttl')
+        with self._cond:
+            self._expire_leases()
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                return _LeaseInfo(-1, 0, [])
+            remaining = int(lease.deadline - time.time())
+            return _LeaseInfo(remaining, lease.ttl, sorted(lease.keys))
+
+    def lock(self, name, ttl=60):
+        return locks.Lock(name, ttl=ttl, etcd_client=self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _WatchResponse(object):
+
+    def __init__(self, header, events):
+        self.header = header
+        self.events = events
+
+
+def _response_to_event_iterator(response_iterator):
+    for response in response_iterator:
+        for event in response.events:
+            yield event
+
+
+def _prefix_end(prefix):
+    s = bytearray(prefix)
+    s[-1] = s[-1] + 1
+    return bytes(s)
+
+
+def client(latency=0, **kwargs):
+    """Return a new in-memory etcd, accepting `etcd3.client` arguments."""
+    return FakeEtcd(latency=latency)
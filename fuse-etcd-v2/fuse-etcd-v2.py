@@ -1,35 +1,195 @@
 #!/usr/bin/env python
 
+import argparse
 import os
 import os.path
-import sys
 import errno
 import logging
+import random
 import stat
+import struct
+import threading
 import time
 
 import etcd3
 from fuse import FUSE, FuseOSError, LoggingMixIn, Operations, fuse_get_context
 import json
 
+import batcher
+import blobs
+import cache
+import compression
+import etcdclient
+import fake_etcd
+import pool
+import stats
 import stm
 
 
-logging.basicConfig(filename='fuse-etcd-v2.log', filemode='w', level=logging.DEBUG)
+# File data is split into fixed size blocks, each stored under its own key.
+BLOCK_SIZE = 64 * 1024
+
+# Inode number of the root directory.
+ROOT_INO = 1
+
+# Default maximum number of entries in the metadata cache.
+META_CACHE_SIZE = 100000
+
+# Access time update policies, as for the Linux strictatime, relatime and
+# noatime mount options.
+ATIME_STRICT = "strictatime"
+ATIME_RELATIME = "relatime"
+ATIME_NOATIME = "noatime"
+ATIME_POLICIES = (ATIME_STRICT, ATIME_RELATIME, ATIME_NOATIME)
+
+# With relatime, access time is updated at least this often (in seconds).
+RELATIME_INTERVAL = 24 * 60 * 60
+
+# Default amount of data buffered per open file in write-back mode before it
+# is committed. etcd limits the size of a request to 1.5 MiB by default.
+WRITEBACK_SIZE = 1024 * 1024
+
+# Maximum number of blocks written by one transaction. Each block touched is
+# written whole, so this bounds the size of a request regardless of how
+# scattered the writes are. etcd limits a request to 1.5 MiB, and a
+# transaction to 128 operations, by default.
+FLUSH_BLOCKS = 16
+
+# Path of a read-only file in the root of the mount, which holds statistics
+# about filesystem operations as JSON. It is not listed by readdir.
+STATS_PATH = "/.stats"
+
+# Key holding the data format of the filesystem as JSON. The format is chosen
+# by the mount which creates the filesystem, and used by every later mount.
+FORMAT_KEY = "format"
+
+# Number of directory entries read per request by readdir.
+READDIR_BATCH = 1000
+
+# Default number of bytes read ahead of a sequential reader.
+READAHEAD_SIZE = 512 * 1024
+
+# Default maximum total size of cached blobs, in deduplication mode.
+BLOB_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default time in seconds for which the kernel caches directory entries, and
+# lookups of paths which do not exist. Changes made through other mounts may
+# not be seen for this long.
+ENTRY_TIMEOUT = 1.0
+NEGATIVE_TIMEOUT = 1.0
+
+# Default etcd endpoints, as (host, port).
+DEFAULT_ENDPOINTS = [("localhost", 2379)]
+
+# Default time in seconds after which an etcd request fails, so that requests
+# to an unreachable member, or one which has lost its leader, do not hang.
+ETCD_TIMEOUT = 10
+
+# Default time to live in seconds of write locks. A lock is released if the
+# mount holding it does not write to the file for this long.
+WRITE_LOCK_TTL = 60
+
+
+class WriteLock(object):
+    """An etcd lock on writing to an inode.
+
+    The lock is shared by every open file of this mount which writes to the
+    inode, and released when the last of them is closed.
+    """
+
+    __slots__ = ('lock', 'refs', 'acquired', 'refreshed', 'mutex')
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.refs = 0
+        # Whether the lock is held. It is no longer held if its lease expires.
+        self.acquired = False
+        # When the lease of the lock was last granted or refreshed.
+        self.refreshed = None
+        self.mutex = threading.Lock()
+
+    def held(self, ttl):
+        """Return whether the lock is held, and its lease has not expired."""
+        return self.acquired and time.time() - self.refreshed < ttl
 
 
 class File(object):
 
-    def __init__(self, fd, path, flags):
+    __slots__ = ('fd', 'path', 'flags', 'ino', 'dirty', 'dirty_size',
+                 'dirty_blocks', 'lock', 'read_blocks', 'read_revision',
+                 'read_end', 'write_lock')
+
+    def __init__(self, fd, path, flags, ino=None):
         self.fd = fd
         self.path = path
         self.flags = flags
+        self.ino = ino
+        # WriteLock held on the inode while the file is open, if write locks
+        # are enabled and the file is open for writing.
+        self.write_lock = None
+        # Buffered writes in write-back mode, as a list of
+        # [offset, chunks, length] extents, oldest first.
+        self.dirty = []
+        self.dirty_size = 0
+        # Numbers of the blocks touched by buffered writes.
+        self.dirty_blocks = set()
+        self.lock = threading.RLock()
+        # Blocks fetched by the last read which needed a request, mapping
+        # block number to content, and the mod_revision of the inode's
+        # metadata when they were read. Every change to a file's data also
+        # changes its metadata, so they are valid while it is unchanged.
+        self.read_blocks = {}
+        self.read_revision = None
+        # End of the last read, to detect sequential reads. A read from the
+        # start of a newly opened file is treated as sequential.
+        self.read_end = 0
+
+    def buffer_write(self, offset, buf):
+        if buf:
+            self.dirty_blocks.update(xrange(
+                offset // BLOCK_SIZE,
+                (offset + len(buf) - 1) // BLOCK_SIZE + 1))
+        if self.dirty:
+            extent = self.dirty[-1]
+            if extent[0] + extent[2] == offset:
+                # Coalesce sequential writes.
+                extent[1].append(buf)
+                extent[2] += len(buf)
+                self.dirty_size += len(buf)
+                return
+        self.dirty.append([offset, [buf], len(buf)])
+        self.dirty_size += len(buf)
+
+    def get_dirty(self):
+        """Return buffered writes as a list of (offset, buf), oldest first."""
+        for extent in self.dirty:
+            if len(extent[1]) > 1:
+                extent[1] = ["".join(extent[1])]
+        return [(offset, chunks[0]) for offset, chunks, _ in self.dirty]
+
+    def get_dirty_end(self):
+        return max([offset + length for offset, _, length in self.dirty] or
+                   [0])
+
+    def clear_dirty(self):
+        self.dirty = []
+        self.dirty_size = 0
+        self.dirty_blocks = set()
 
 
 class Meta(object):
-    """File metadata, stored in etcd as JSON."""
+    """File metadata, stored in etcd in a fixed binary layout.
+
+    Encoded metadata starts with a version byte. Metadata written before the
+    binary encoding was introduced is JSON, and is still decoded.
+    """
 
-    attrs = {'atime', 'ctime', 'gid', 'mode', 'mtime', 'nlink', 'size', 'uid'}
+    attrs = ('atime', 'ctime', 'gid', 'mode', 'mtime', 'nlink', 'size', 'uid')
+    __slots__ = attrs
+
+    VERSION = 1
+    # Version, then mode, nlink, uid, gid, size, atime, mtime and ctime.
+    STRUCT = struct.Struct("<BIIIIQqqq")
 
     def __init__(self, atime, ctime, gid, mode, mtime, nlink, size, uid):
         self.atime = atime
@@ -42,11 +202,19 @@ class Meta(object):
         self.uid = uid
 
     @classmethod
-    def from_json(cls, meta_json):
-        return cls(**json.loads(meta_json))
-
-    def to_json(self):
-        return json.dumps({attr: getattr(self, attr) for attr in self.attrs})
+    def decode(cls, value):
+        if value.startswith("{"):
+            return cls(**json.loads(value))
+        (version, mode, nlink, uid, gid, size, atime, mtime,
+         ctime) = cls.STRUCT.unpack(value)
+        if version != cls.VERSION:
+            raise ValueError("Unsupported metadata version %d" % version)
+        return cls(atime, ctime, gid, mode, mtime, nlink, size, uid)
+
+    def encode(self):
+        return self.STRUCT.pack(self.VERSION, self.mode, self.nlink, self.uid,
+                                self.gid, self.size, self.atime, self.mtime,
+                                self.ctime)
 
     def to_stat(self):
         return {"st_" + attr: meta[attr] for attr in attrs}
@@ -67,63 +235,795 @@ class Meta(object):
         # As returned by getattr()
         return {"st_" + field: getattr(self, field) for field in self.attrs}
 
+    def needs_atime(self, policy):
+        """Return whether a read should update the access time."""
+        if policy == ATIME_STRICT:
+            return True
+        if policy == ATIME_NOATIME:
+            return False
+        now = int(time.time())
+        if self.atime == now:
+            # Times have a resolution of one second, so the access time would
+            # not change. Otherwise every read in the same second as a write
+            # would update it.
+            return False
+        return (self.atime <= self.mtime or self.atime <= self.ctime or
+                now - self.atime >= RELATIME_INTERVAL)
+
 
 class EtcdFSV2(LoggingMixIn, Operations):
-    def __init__(self):
-        grpc_options = [
-            ('grpc.max_receive_message_length', 100 * 1024 * 1024),
-            ('grpc.max_send_message_length', 100 * 1024 * 1024),
-        ]
-        self.client = etcd3.client(grpc_options=grpc_options)
-        # TODO: test client.
-        self.fds = [None] * 1024
+    def __init__(self, meta_cache_size=META_CACHE_SIZE, writeback=False,
+                 writeback_size=WRITEBACK_SIZE, atime=ATIME_RELATIME,
+                 retry_policy=None, isolation=stm.SERIALIZABLE_SNAPSHOT,
+                 client=None, dedup=False, blob_cache_size=BLOB_CACHE_SIZE,
+                 codec=compression.NONE, readahead=READAHEAD_SIZE,
+                 batch_reads=False, batch_window=0,
+                 endpoints=DEFAULT_ENDPOINTS, timeout=None, write_locks=False,
+                 write_lock_ttl=WRITE_LOCK_TTL):
+        if client is None:
+            grpc_options = [
+                ('grpc.max_receive_message_length', 100 * 1024 * 1024),
+                ('grpc.max_send_message_length', 100 * 1024 * 1024),
+            ]
+            client = pool.client(endpoints, timeout=timeout,
+                                 grpc_options=grpc_options)
+        self.client = client
+        # Latency and etcd requests of each filesystem operation.
+        self.stats = stats.OperationStats()
+        etcdclient.instrument(self.client, self.stats.record_rpc)
+        # Reads of single keys by concurrent operations may be combined into
+        # one request.
+        self.batcher = None
+        if batch_reads:
+            self.batcher = batcher.Batcher(self.client, window=batch_window)
+        # Snapshot of statistics returned by the last getattr of STATS_PATH,
+        # and the snapshot read by each open handle of it.
+        self.stats_snapshot = ""
+        self.stats_handles = {}
+        # Maps the handle of each open file to its File. Handles of closed
+        # files are kept in free_fds for reuse, so handles stay small.
+        self.fds = {}
+        self.free_fds = []
+        self.fds_lock = threading.Lock()
+        # In write-back mode, writes are buffered per open file until flushed.
+        self.writeback = writeback
+        self.writeback_size = writeback_size
+        # With write locks, a file open for writing holds a lock on it, so
+        # that writers through other mounts wait rather than conflict, and
+        # writes are buffered as in write-back mode. Maps inode numbers to
+        # WriteLocks held by this mount.
+        self.write_locks = write_locks
+        self.write_lock_ttl = write_lock_ttl
+        self.inode_locks = {}
+        # Keeps the leases of held write locks alive while the mount runs.
+        self.lock_keeper = None
+        self.lock_keeper_stopped = threading.Event()
+        # Maps inode numbers to the set of open files with buffered writes.
+        self.dirty_files = {}
+        # Unless access time needs updating, reads do not write to etcd, and
+        # so do not conflict with each other.
+        self.atime = atime
+        # Number of bytes fetched beyond a sequential read, and served to
+        # later reads from the open file without a request.
+        self.readahead = readahead
+        self.retry_policy = retry_policy
+        # With snapshot isolation, a transaction reads all keys at one
+        # revision, so it never sees a partially applied change.
+        self.isolation = isolation
+        # In deduplication mode, blocks hold the digest of a blob holding
+        # their content. This may be overridden by the format of an existing
+        # filesystem on init.
+        self.dedup = dedup
+        # Data is compressed with this codec when written, if the filesystem
+        # stores a header byte identifying the codec of each value.
+        self.codec = codec
+        self.block_headers = True
+        self.blobs = blobs.BlobStore(self.client, blob_cache_size,
+                                     self._get_stm, self._encode_data,
+                                     self._decode_data)
         self.logger = logging.getLogger('etcdfs')
+        # Caches of metadata and directory entries, kept up to date by
+        # watching the inode/ and dentry/ prefixes.
+        self.meta_cache = cache.WatchedCache(self.client, "inode/",
+                                             meta_cache_size, Meta.decode)
+        self.dentry_cache = cache.WatchedCache(self.client, "dentry/",
+                                               meta_cache_size,
+                                               self._decode_ino)
+
+    def __call__(self, op, path, *args):
+        if path == STATS_PATH:
+            return self._stats_call(op, *args)
+        if op == 'readdir':
+            # readdir returns a generator, which makes its requests as it is
+            # iterated, so it is the iteration which is measured.
+            return self.stats.iterate(op, self._dispatch(op, path, *args))
+        with self.stats.operation(op):
+            return self._dispatch(op, path, *args)
+
+    def _dispatch(self, op, path, *args):
+        try:
+            # LoggingMixIn formats the arguments of every call, even if debug
+            # logging is disabled, so only use it when it will log.
+            if self.log.isEnabledFor(logging.DEBUG):
+                return LoggingMixIn.__call__(self, op, path, *args)
+            return Operations.__call__(self, op, path, *args)
+        except stm.Conflict as e:
+            # The transaction ran out of retries under contention, which the
+            # caller may retry.
+            self.logger.warning("%s %s conflicted on %s", op, path, e.keys)
+            raise FuseOSError(errno.EAGAIN)
 
     # Helpers
     # =======
 
-    def _create_file(self, path, flags):
+    def _create_file(self, path, flags, ino=None):
+        with self.fds_lock:
+            if self.free_fds:
+                fd = self.free_fds.pop()
+            else:
+                # Every handle below the number of open files is in use.
+                fd = len(self.fds)
+            file = self.fds[fd] = File(fd, path, flags, ino)
+            return file
+
+    def _acquire_write_lock(self, file):
+        """Lock an inode for writing by an open file.
+
+        Waits up to the time to live of the lock for other mounts to release
+        it, then raises EAGAIN.
+        """
+        with self.fds_lock:
+            write_lock = self.inode_locks.get(file.ino)
+            if write_lock is None:
+                write_lock = WriteLock(self.client.lock(
+                    "ffs/" + self._encode_ino(file.ino),
+                    ttl=self.write_lock_ttl))
+                self.inode_locks[file.ino] = write_lock
+            write_lock.refs += 1
+        file.write_lock = write_lock
+        if not self._ensure_locked(write_lock):
+            self._release_write_lock(file)
+            raise FuseOSError(errno.EAGAIN)
+
+    def _ensure_locked(self, write_lock):
+        """Acquire a write lock unless it is held, and return whether it is.
+
+        Waits up to the time to live of the lock for other mounts to release
+        it.
+        """
+        with write_lock.mutex:
+            if not write_lock.held(self.write_lock_ttl):
+                write_lock.refreshed = time.time()
+                write_lock.acquired = write_lock.lock.acquire(
+                    timeout=self.write_lock_ttl)
+            return write_lock.acquired
+
+    def _check_write_lock(self, file):
+        """Ensure that a file holds its write lock before writing to it.
+
+        If the lease of the lock expired, another mount may have taken it, so
+        it is acquired again, or EAGAIN raised.
+        """
+        if not self._ensure_locked(file.write_lock):
+            raise FuseOSError(errno.EAGAIN)
+
+    def _keep_write_locks(self):
+        """Refresh the leases of held write locks until the mount stops."""
+        while not self.lock_keeper_stopped.wait(self.write_lock_ttl / 3.0):
+            with self.fds_lock:
+                write_locks = list(self.inode_locks.values())
+            for write_lock in write_locks:
+                # A lock being acquired is not yet held, and acquiring it may
+                # take a while, so is not waited for.
+                if not write_lock.mutex.acquire(False):
+                    continue
+                try:
+                    if write_lock.acquired:
+                        self._refresh_write_lock(write_lock)
+                finally:
+                    write_lock.mutex.release()
+
+    def _refresh_write_lock(self, write_lock):
+        """Refresh the lease of a held write lock, with its mutex held.
+
+        A lock whose lease has expired, for example because the keeper was
+        delayed, or which could not be refreshed within its time to live, is
+        marked as no longer held.
+        """
+        refreshed = time.time()
         try:
-            free_fd = self.fds.index(None)
-        except ValueError:
-            # TODO
-            raise
-        self.fds[free_fd] = File(free_fd, path, flags)
-        return self.fds[free_fd]
+            responses = write_lock.lock.refresh()
+        except Exception:
+            self.logger.exception("Failed to refresh write lock %s",
+                                  write_lock.lock.key)
+            expired = not write_lock.held(self.write_lock_ttl)
+        else:
+            expired = not responses or responses[0].TTL <= 0
+            if not expired:
+                write_lock.refreshed = refreshed
+        if expired:
+            self.logger.warning("Lease of write lock %s expired",
+                                write_lock.lock.key)
+            write_lock.acquired = False
+
+    def _release_write_lock(self, file):
+        write_lock, file.write_lock = file.write_lock, None
+        with self.fds_lock:
+            write_lock.refs -= 1
+            if write_lock.refs:
+                return
+            del self.inode_locks[file.ino]
+        with write_lock.mutex:
+            if write_lock.acquired:
+                write_lock.lock.release()
+                write_lock.acquired = False
 
     def _get_file(self, fd):
-        return self.fds[fd]
+        try:
+            return self.fds[fd]
+        except KeyError:
+            raise FuseOSError(errno.EBADF)
 
     def _close_file(self, fd):
-        self.fds.pop(fd)
+        with self.fds_lock:
+            if self.fds.pop(fd, None) is not None:
+                self.free_fds.append(fd)
+
+    @staticmethod
+    def _new_ino():
+        """Return a new inode number.
+
+        Inode numbers are random, so that concurrent creates do not contend
+        on a counter. A create fails to commit if the number is in use.
+        """
+        while True:
+            ino = random.getrandbits(63)
+            if ino > ROOT_INO:
+                return ino
+
+    @staticmethod
+    def _encode_ino(ino):
+        return "%016x" % ino
+
+    @staticmethod
+    def _decode_ino(value):
+        return int(value, 16)
+
+    @classmethod
+    def _get_inode_key(cls, ino):
+        """Return the etcd key for metadata of an inode."""
+        return "inode/" + cls._encode_ino(ino)
+
+    @classmethod
+    def _get_data_key(cls, ino):
+        """Return the etcd key prefix for data blocks of an inode."""
+        return "block/" + cls._encode_ino(ino) + "/"
+
+    @classmethod
+    def _get_block_key(cls, ino, block):
+        """Return the etcd key for a block of data of an inode."""
+        return cls._get_data_key(ino) + "%08x" % block
+
+    @classmethod
+    def _get_data_range(cls, ino, first_block=0):
+        """Return the etcd key range holding an inode's data blocks.
+
+        The range starts at first_block and extends to the end of the file.
+        """
+        data_key = cls._get_data_key(ino)
+        # '0' sorts immediately after '/', so this ends the prefix.
+        return cls._get_block_key(ino, first_block), data_key[:-1] + "0"
 
     @staticmethod
-    def _get_meta_key(path):
-        """Return the etcd key for metadata for a given path."""
-        return os.path.join("meta", path.lstrip('/'))
+    def _get_blocks(offset, length):
+        """Return the block numbers covering [offset, offset + length)."""
+        if length <= 0:
+            return xrange(0)
+        return xrange(offset // BLOCK_SIZE,
+                      (offset + length - 1) // BLOCK_SIZE + 1)
 
     @staticmethod
-    def _get_data_key(path):
-        """Return the etcd key for data for a given path."""
-        return os.path.join("data", path.lstrip('/'))
+    def _get_block_count(size):
+        return (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    @classmethod
+    def _get_dentry_prefix(cls, ino):
+        """Return the etcd key prefix for entries of a directory inode.
+
+        Each directory entry is stored under dentry/<parent ino>/<name>, and
+        holds the inode number of the entry, so the entries of a directory
+        can be listed with a range read.
+        """
+        return "dentry/" + cls._encode_ino(ino) + "/"
+
+    @classmethod
+    def _get_dentry_key(cls, parent_ino, name):
+        """Return the etcd key for an entry of a directory inode."""
+        return cls._get_dentry_prefix(parent_ino) + name
 
     @staticmethod
-    def _get_path_from_meta_key(meta_key):
-        return meta_key[5:]
+    def _split_path(path):
+        return [name for name in path.split('/') if name]
 
-    def _get_meta(self, path):
-        meta_key = self._get_meta_key(path)
-        meta, kv = self.client.get(meta_key)
-        if meta is not None:
-            meta = Meta.from_json(meta)
-        return meta, kv
+    def _get_cached(self, cache, key):
+        """Return the decoded value of a key, or None if it does not exist.
 
-    def _get_data(self, path):
-        data_key = self._get_data_key(path)
-        return self.client.get(data_key)
+        Keys which do not exist are cached as tombstones, so that repeated
+        lookups of missing paths, such as the probes made by compilers and
+        imports, need no request. The returned value may be shared with the
+        cache, and must not be modified.
+        """
+        entry = cache.get_entry(key)
+        if entry is not None:
+            return entry[0]
+        if self.batcher is not None:
+            response = self.batcher.get_response(key)
+        else:
+            response = self.client.get_response(key)
+        if not response.kvs:
+            # The tombstone is tagged with the revision of the read, so that
+            # changes before it, replayed by a lagging watch, do not replace
+            # it.
+            cache.put(key, None, response.header.revision,
+                      response.header.revision)
+            return None
+        kv = response.kvs[0]
+        value = cache.decode(kv.value)
+        cache.put(key, value, kv.mod_revision, response.header.revision)
+        return value
+
+    def _lookup(self, path):
+        """Return the inode number of a path, or None if it does not exist.
+
+        Directory entries are read from the cache where possible, and not
+        within a transaction.
+        """
+        ino = ROOT_INO
+        for name in self._split_path(path):
+            ino = self._get_cached(self.dentry_cache,
+                                   self._get_dentry_key(ino, name))
+            if ino is None:
+                return None
+        return ino
+
+    def _get_meta(self, ino):
+        """Return metadata of an inode, or None if it does not exist.
+
+        The returned Meta may be shared with the metadata cache, and must not
+        be modified.
+        """
+        return self._get_cached(self.meta_cache, self._get_inode_key(ino))
+
+    def _resolve(self, s, path):
+        """Return the inode number of a path within an STM, or None.
+
+        Every directory entry on the path is read through the STM, so the
+        transaction conflicts with a concurrent rename or removal of the path
+        or any of its ancestors.
+        """
+        ino = ROOT_INO
+        for name in self._split_path(path):
+            value = s.get(self._get_dentry_key(ino, name))
+            if value is None:
+                return None
+            ino = self._decode_ino(value)
+        return ino
+
+    def _resolve_entry(self, s, path):
+        """Resolve the directory entry of a path within an STM.
+
+        Returns the inode number of the parent directory, the key of the
+        entry, and the inode number of the entry, or None if there is no such
+        entry. Raises ENOENT if the parent directory does not exist.
+        """
+        parent, name = os.path.split(path)
+        parent_ino = self._resolve(s, parent)
+        if parent_ino is None:
+            raise FuseOSError(errno.ENOENT)
+        dentry_key = self._get_dentry_key(parent_ino, name)
+        value = s.get(dentry_key)
+        if value is None:
+            return parent_ino, dentry_key, None
+        return parent_ino, dentry_key, self._decode_ino(value)
+
+    def _resolve_meta(self, s, path):
+        """Return the inode number and metadata of a path within an STM.
+
+        Raises ENOENT if the path does not exist.
+        """
+        ino = self._resolve(s, path)
+        meta = s.get(self._get_inode_key(ino)) if ino is not None else None
+        if meta is None:
+            raise FuseOSError(errno.ENOENT)
+        return ino, Meta.decode(meta)
+
+    def _encode_data(self, data):
+        """Return the value to store for a block or blob of data."""
+        if not self.block_headers:
+            return data
+        return compression.encode(data, self.codec)
+
+    def _decode_data(self, value):
+        if not self.block_headers:
+            return value
+        return compression.decode(value)
+
+    def _load_blocks(self, s, ino, blocks):
+        """Read blocks of a file's data within an STM.
+
+        Returns a dict mapping each block number to its content, or None if
+        the block is a hole.
+        """
+        values = [s.get(self._get_block_key(ino, block)) for block in blocks]
+        if self.dedup:
+            contents = self.blobs.get([value for value in values
+                                       if value is not None])
+            values = [contents.get(value) for value in values]
+        else:
+            values = [self._decode_data(value) if value is not None else None
+                      for value in values]
+        return dict(zip(blocks, values))
+
+    def _assemble_blocks(self, contents, offset, length):
+        """Return [offset, offset + length) of a file from its blocks.
+
+        Blocks are not padded when stored, and missing blocks are holes, so
+        any bytes not present in etcd read as zeroes.
+        """
+        chunks = []
+        for block in self._get_blocks(offset, length):
+            block_offset = block * BLOCK_SIZE
+            start = max(offset, block_offset) - block_offset
+            end = min(offset + length, block_offset + BLOCK_SIZE) - block_offset
+            chunk = (contents[block] or "")[start:end]
+            chunks.append(chunk + "\0" * (end - start - len(chunk)))
+        return "".join(chunks)
+
+    def _get_block(self, s, block_key, changes=None):
+        """Return the content of a block, or None if it is a hole."""
+        if changes is not None:
+            return changes.get_block(s, block_key)
+        value = s.get(block_key)
+        return self._decode_data(value) if value is not None else None
+
+    def _put_block(self, s, block_key, content, changes=None):
+        if changes is not None:
+            changes.put_block(s, block_key, content)
+        else:
+            s.put(block_key, self._encode_data(content))
+
+    def _release_blocks(self, s, ino, first_block=0):
+        """Queue release of the blobs referenced by a file's blocks.
+
+        Only needed in deduplication mode, where it returns the key to pass to
+        BlobStore.collect once the STM commits. The blocks themselves must
+        also be deleted by the caller.
+        """
+        if not self.dedup:
+            return None
+        return self.blobs.enqueue(s, self.blobs.get_digests(
+            s, *self._get_data_range(ino, first_block)))
+
+    def _collect(self, gc_key):
+        if gc_key is not None:
+            self.blobs.collect(gc_key)
+
+    def _write_blocks(self, s, ino, offset, buf, changes=None):
+        """Write buf at offset to a file's data within an STM.
+
+        Only the blocks covering the write are touched, and blocks that are
+        completely overwritten are not read. In deduplication mode, changes
+        records the blob references added and removed.
+        """
+        for block in self._get_blocks(offset, len(buf)):
+            block_offset = block * BLOCK_SIZE
+            start = max(offset, block_offset)
+            end = min(offset + len(buf), block_offset + BLOCK_SIZE)
+            chunk = buf[start - offset:end - offset]
+            block_key = self._get_block_key(ino, block)
+            if len(chunk) < BLOCK_SIZE:
+                value = self._get_block(s, block_key, changes) or ""
+                start -= block_offset
+                if len(value) < start:
+                    value += "\0" * (start - len(value))
+                chunk = value[:start] + chunk + value[start + len(chunk):]
+            self._put_block(s, block_key, chunk, changes)
+
+    def _truncate_blocks(self, s, ino, size, length):
+        """Truncate a file's data from size to length bytes within an STM.
+
+        Returns the result of _release_blocks for the removed blocks.
+        """
+        if length >= size:
+            # Extending a file leaves a hole, which reads as zeroes.
+            return None
+        first_block = self._get_block_count(length)
+        gc_key = self._release_blocks(s, ino, first_block)
+        s.delete_range(*self._get_data_range(ino, first_block))
+        if length % BLOCK_SIZE:
+            changes = blobs.Changes(self.blobs) if self.dedup else None
+            block_key = self._get_block_key(ino, length // BLOCK_SIZE)
+            value = self._get_block(s, block_key, changes)
+            if value is not None and len(value) > length % BLOCK_SIZE:
+                self._put_block(s, block_key, value[:length % BLOCK_SIZE],
+                                changes)
+            if changes is not None:
+                changes.apply(s)
+        return gc_key
+
+    def _get_partial_block_keys(self, ino, offset, length):
+        """Return keys of blocks partially covered by a write, to prefetch.
+
+        In deduplication mode, the digest held by every block written is
+        needed, so all are returned.
+        """
+        keys = []
+        for block in self._get_blocks(offset, length):
+            block_offset = block * BLOCK_SIZE
+            if (self.dedup or offset > block_offset or
+                    offset + length < block_offset + BLOCK_SIZE):
+                keys.append(self._get_block_key(ino, block))
+        return keys
+
+    def _write_extents(self, ino, extents):
+        """Write a list of (offset, buf) to a file in one transaction.
+
+        Returns False if the file does not exist.
+        """
+        meta_key = self._get_inode_key(ino)
+        block_keys = set()
+        for offset, buf in extents:
+            block_keys.update(
+                self._get_partial_block_keys(ino, offset, len(buf)))
+        end = max(offset + len(buf) for offset, buf in extents)
+
+        s = self._get_stm()
+
+        @s.retried_transaction(prefetch_keys=[meta_key] + sorted(block_keys))
+        def _write(s):
+            meta = s.get(meta_key)
+            if meta is None:
+                return False
+            meta = Meta.decode(meta)
+            # Update size and modified times.
+            meta.size = max(meta.size, end)
+            meta.touch(atime=True, ctime=True, mtime=True)
+            s.put(meta_key, meta.encode())
+            changes = blobs.Changes(self.blobs) if self.dedup else None
+            for offset, buf in extents:
+                self._write_blocks(s, ino, offset, buf, changes)
+            if changes is not None:
+                changes.apply(s)
+            return True
+
+        return _write()
+
+    def _commit_extents(self, ino, extents):
+        """Write a list of (offset, buf) to a file.
+
+        The writes are committed in order, in as few transactions as
+        possible, each writing at most FLUSH_BLOCKS blocks. Returns False if
+        the file does not exist.
+        """
+        # Each batch is a list of [offset, chunks, length] extents.
+        batch = []
+        batch_blocks = set()
+        for offset, buf in extents:
+            # Split each write at block boundaries, so that no transaction
+            # exceeds the limit.
+            for block in self._get_blocks(offset, len(buf)):
+                start = max(offset, block * BLOCK_SIZE)
+                end = min(offset + len(buf), (block + 1) * BLOCK_SIZE)
+                if (block not in batch_blocks and
+                        len(batch_blocks) >= FLUSH_BLOCKS):
+                    if not self._write_batch(ino, batch):
+                        return False
+                    batch = []
+                    batch_blocks = set()
+                chunk = buf[start - offset:end - offset]
+                if batch and batch[-1][0] + batch[-1][2] == start:
+                    # Rejoin the pieces of a write within a batch.
+                    batch[-1][1].append(chunk)
+                    batch[-1][2] += len(chunk)
+                else:
+                    batch.append([start, [chunk], len(chunk)])
+                batch_blocks.add(block)
+        return self._write_batch(ino, batch)
+
+    def _write_batch(self, ino, batch):
+        if not batch:
+            return True
+        return self._write_extents(
+            ino, [(offset, "".join(chunks)) for offset, chunks, _ in batch])
+
+    def _flush_file(self, file):
+        """Commit an open file's buffered writes."""
+        with file.lock:
+            if not file.dirty:
+                return
+            # If the file has been removed, the data is discarded.
+            self._commit_extents(file.ino, file.get_dirty())
+            file.clear_dirty()
+            with self.fds_lock:
+                files = self.dirty_files.get(file.ino)
+                if files is not None:
+                    files.discard(file)
+                    if not files:
+                        del self.dirty_files[file.ino]
+
+    def _flush_inode(self, ino):
+        """Commit buffered writes of all open files for an inode."""
+        with self.fds_lock:
+            files = list(self.dirty_files.get(ino, ()))
+        for file in files:
+            self._flush_file(file)
+
+    def _flush_other_files(self, file):
+        """Commit writes buffered by other open files of the same inode."""
+        if not self.dirty_files:
+            return
+        with self.fds_lock:
+            files = [other for other in self.dirty_files.get(file.ino, ())
+                     if other is not file]
+        for other in files:
+            self._flush_file(other)
+
+    def _get_dirty_end(self, ino):
+        """Return the end of buffered writes to an inode, or 0."""
+        if not self.dirty_files:
+            return 0
+        with self.fds_lock:
+            files = list(self.dirty_files.get(ino, ()))
+        return max([file.get_dirty_end() for file in files] or [0])
 
     def _get_stm(self):
-        return stm.STM(self.client)
+        return stm.STM(self.client, on_commit=self._on_commit,
+                       retry_policy=self.retry_policy,
+                       isolation=self.isolation, batcher=self.batcher)
+
+    def _on_commit(self, s):
+        # Cache modified metadata and directory entries, so that they can be
+        # used before the watch reports the change. Range deletions only
+        # remove data blocks.
+        for key, value in s.wset.items():
+            if key.startswith("inode/"):
+                cache, decode = self.meta_cache, Meta.decode
+            elif key.startswith("dentry/"):
+                cache, decode = self.dentry_cache, self._decode_ino
+            else:
+                continue
+            value = decode(value) if value is not None else None
+            cache.put(key, value, s.commit_revision, s.commit_revision)
+
+    def _get_stats(self):
+        return json.dumps({
+            "filesystem": self.stats.to_dict(),
+            "stm": stm.METRICS.to_dict(),
+        }, indent=2, sort_keys=True) + "\n"
+
+    def _stats_call(self, op, *args):
+        """Handle an operation on STATS_PATH."""
+        if op == "getattr":
+            # The kernel reads no more than the size returned here, so the
+            # snapshot is taken now, and returned by the next open.
+            self.stats_snapshot = self._get_stats()
+            now = int(time.time())
+            return Meta(now, now, 0, stat.S_IFREG | 0o444, now, 1,
+                        len(self.stats_snapshot), 0).to_attr()
+        if op == "open":
+            file = self._create_file(STATS_PATH, args[0])
+            self.stats_handles[file.fd] = self.stats_snapshot
+            return file.fd
+        if op == "read":
+            length, offset, fh = args
+            return self.stats_handles[fh][offset:offset + length]
+        if op == "release":
+            fh = args[-1]
+            self.stats_handles.pop(fh, None)
+            self._close_file(fh)
+            return 0
+        if op in ("access", "flush", "fsync"):
+            return 0
+        raise FuseOSError(errno.EACCES)
+
+    def _cache_entries(self, response):
+        """Cache a batch of directory entries read by readdir.
+
+        The metadata of each entry is also read and cached, so that a
+        following getattr of each entry, as by ls -l, needs no request.
+        """
+        if not self.meta_cache.is_active():
+            return
+        revision = response.header.revision
+        meta_keys = []
+        for kv in response.kvs:
+            ino = self._decode_ino(kv.value)
+            self.dentry_cache.put(kv.key, ino, kv.mod_revision, revision)
+            meta_key = self._get_inode_key(ino)
+            if self.meta_cache.get_entry(meta_key) is None:
+                meta_keys.append(meta_key)
+        # Metadata is read at the revision of the entries, with the requests
+        # pipelined.
+        responses = etcdclient.get_many_responses(self.client, meta_keys,
+                                                  revision=revision)
+        for meta_key, meta_response in zip(meta_keys, responses):
+            for kv in meta_response.kvs:
+                self.meta_cache.put(meta_key, Meta.decode(kv.value),
+                                    kv.mod_revision, revision)
+
+    def _seed_meta(self, s, ino):
+        """Seed an STM's read set with cached metadata, saving a read."""
+        meta_key = self._get_inode_key(ino)
+        entry = self.meta_cache.get_entry(meta_key)
+        if entry is None:
+            return
+        meta, mod_revision = entry
+        if meta is None:
+            s.seed(meta_key, None, 0)
+        else:
+            s.seed(meta_key, meta.encode(), mod_revision)
+
+    def _seed_paths(self, s, *paths):
+        """Seed an STM's read set with cached entries and metadata of paths.
+
+        Returns the inode number of each path, or None where it is not known
+        from the cache.
+        """
+        inos = []
+        for path in paths:
+            ino = ROOT_INO
+            for name in self._split_path(path):
+                dentry_key = self._get_dentry_key(ino, name)
+                entry = self.dentry_cache.get_entry(dentry_key)
+                if entry is None or entry[0] is None:
+                    if entry is not None:
+                        s.seed(dentry_key, None, 0)
+                    ino = None
+                    break
+                ino, mod_revision = entry
+                s.seed(dentry_key, self._encode_ino(ino), mod_revision)
+            if ino is not None:
+                self._seed_meta(s, ino)
+            inos.append(ino)
+        return inos
+
+    def _touch_dir(self, s, ino):
+        """Update the change and modification times of a directory."""
+        meta_key = self._get_inode_key(ino)
+        meta = s.get(meta_key)
+        if meta is None:
+            raise FuseOSError(errno.ENOENT)
+        meta = Meta.decode(meta)
+        if not meta.is_dir():
+            raise FuseOSError(errno.ENOTDIR)
+        meta.touch(ctime=True, mtime=True)
+        s.put(meta_key, meta.encode())
+
+    def _unlink_inode(self, s, ino, meta):
+        """Remove a link to an inode within an STM.
+
+        The inode and its data are removed with its last link. Returns the
+        result of _release_blocks.
+        """
+        meta_key = self._get_inode_key(ino)
+        meta.nlink -= 1
+        if meta.nlink > 0 and not meta.is_dir():
+            meta.touch(ctime=True)
+            s.put(meta_key, meta.encode())
+            return None
+        s.delete(meta_key)
+        gc_key = self._release_blocks(s, ino)
+        s.delete_range(*self._get_data_range(ino))
+        return gc_key
+
+    def _has_entries(self, ino):
+        """Return whether a directory has any entries."""
+        dentry_prefix = self._get_dentry_prefix(ino)
+        response = etcdclient.get_range_response(
+            self.client, dentry_prefix,
+            etcd3.utils.increment_last_byte(dentry_prefix), limit=1,
+            keys_only=True)
+        return bool(response.kvs)
 
     def _validate_path(self, path):
         for part in path.split(os.path.sep):
@@ -135,8 +1035,26 @@ class EtcdFSV2(LoggingMixIn, Operations):
 
     def init(self, path):
         assert path == '/'
+        self._migrate_paths()
         # Ensure root directory exists.
-        self._ensure_file(path, 0o777 | stat.S_IFDIR, None)
+        created, _ = self._ensure_file(path, 0o777 | stat.S_IFDIR, None)
+        if not created:
+            self._load_format()
+        if self.dedup:
+            self.blobs.collect_all()
+        self.meta_cache.start()
+        self.dentry_cache.start()
+        if self.write_locks:
+            self.lock_keeper = threading.Thread(target=self._keep_write_locks)
+            self.lock_keeper.daemon = True
+            self.lock_keeper.start()
+
+    def destroy(self, path):
+        self.meta_cache.stop()
+        self.dentry_cache.stop()
+        if self.lock_keeper:
+            self.lock_keeper_stopped.set()
+            self.lock_keeper.join(1)
 
     def access(self, path, mode):
         #meta, kv = self._get_meta(path)
@@ -146,58 +1064,67 @@ class EtcdFSV2(LoggingMixIn, Operations):
         pass
 
     def chmod(self, path, mode):
-        meta_key = self._get_meta_key(path)
-
         s = self._get_stm()
 
-        @s.retried_transaction()
+        @s.retried_transaction(seed=lambda s: self._seed_paths(s, path))
         def _chmod(s):
-            meta = Meta.from_json(s.get(meta_key))
+            ino, meta = self._resolve_meta(s, path)
             # Update mode and ctime.
             meta.mode = mode
             meta.touch(ctime=True)
-            s.put(meta_key, meta.to_json())
+            s.put(self._get_inode_key(ino), meta.encode())
 
         _chmod()
         return 0
 
     def chown(self, path, uid, gid):
-        meta_key = self._get_meta_key(path)
-
         s = self._get_stm()
 
-        @s.retried_transaction()
+        @s.retried_transaction(seed=lambda s: self._seed_paths(s, path))
         def _chown(s):
-            meta = Meta.from_json(s.get(meta_key))
+            ino, meta = self._resolve_meta(s, path)
             # Update owner and ctime.
             meta.uid = uid
             meta.gid = gid
             meta.touch(ctime=True)
-            s.put(meta_key, meta.to_json())
+            s.put(self._get_inode_key(ino), meta.encode())
 
         _chown()
         return 0
 
     def getattr(self, path, fh=None):
         try:
-            meta, kv = self._get_meta(path)
+            ino = self._lookup(path)
+            meta = self._get_meta(ino) if ino is not None else None
         except Exception as e:
             print e
             raise FuseOSError(errno.ENOENT)
         else:
-            if meta is None and kv is None:
+            if meta is None:
                 raise FuseOSError(errno.ENOENT)
             else:
-                return meta.to_attr()
+                attr = meta.to_attr()
+                attr['st_ino'] = ino
+                # Include writes which have not yet been committed.
+                attr['st_size'] = max(meta.size, self._get_dirty_end(ino))
+                return attr
 
     def readdir(self, path, fh):
+        ino = self._lookup(path)
+        if ino is None:
+            raise FuseOSError(errno.ENOENT)
         yield '.'
         yield '..'
-        path = path.lstrip('/')
-        for _, kv in self.client.get_prefix(self._get_meta_key(path), keys_only=True):
-            file_path = self._get_path_from_meta_key(kv.key)
-            if os.path.split(file_path)[0] == path:
-                yield os.path.split(file_path)[-1]
+        dentry_prefix = self._get_dentry_prefix(ino)
+        # Entries are read in batches, so that memory use does not depend on
+        # the size of the directory.
+        for response in etcdclient.iter_range_responses(
+                self.client, dentry_prefix,
+                etcd3.utils.increment_last_byte(dentry_prefix),
+                READDIR_BATCH):
+            self._cache_entries(response)
+            for kv in response.kvs:
+                yield kv.key[len(dentry_prefix):]
 
     def readlink(self, path):
         raise NotImplementedError
@@ -206,22 +1133,32 @@ class EtcdFSV2(LoggingMixIn, Operations):
         raise NotImplementedError
 
     def rmdir(self, path):
-        meta_key = self._get_meta_key(path)
-
         s = self._get_stm()
 
-        @s.retried_transaction()
+        @s.retried_transaction(seed=lambda s: self._seed_paths(
+            s, os.path.dirname(path), path))
         def _rmdir(s):
-            meta = Meta.from_json(s.get(meta_key))
-            if not meta.is_dir():
+            parent_ino, dentry_key, ino = self._resolve_entry(s, path)
+            if ino is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = s.get(self._get_inode_key(ino))
+            if meta is None:
+                raise FuseOSError(errno.ENOENT)
+            if not Meta.decode(meta).is_dir():
                 raise FuseOSError(errno.ENOTDIR)
-            s.delete(meta_key)
+            # Creating an entry updates the directory's metadata, so the
+            # commit fails if one is created after this check.
+            if self._has_entries(ino):
+                raise FuseOSError(errno.ENOTEMPTY)
+            s.delete(dentry_key)
+            s.delete(self._get_inode_key(ino))
+            self._touch_dir(s, parent_ino)
 
         _rmdir()
         return 0
 
     def mkdir(self, path, mode):
-        created = self._ensure_file(path, mode | stat.S_IFDIR, None)
+        created, _ = self._ensure_file(path, mode | stat.S_IFDIR, None)
         if not created:
             raise FuseOSError(errno.EEXIST)
 
@@ -256,54 +1193,197 @@ class EtcdFSV2(LoggingMixIn, Operations):
         }
 
     def unlink(self, path):
-        meta_key = self._get_meta_key(path)
-        data_key = self._get_data_key(path)
-
         s = self._get_stm()
 
-        @s.retried_transaction()
+        @s.retried_transaction(seed=lambda s: self._seed_paths(
+            s, os.path.dirname(path), path))
         def _unlink(s):
-            s.delete(meta_key)
-            s.delete(data_key)
-
-        _unlink()
+            parent_ino, dentry_key, ino = self._resolve_entry(s, path)
+            if ino is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = s.get(self._get_inode_key(ino))
+            if meta is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = Meta.decode(meta)
+            if meta.is_dir():
+                raise FuseOSError(errno.EISDIR)
+            s.delete(dentry_key)
+            self._touch_dir(s, parent_ino)
+            return self._unlink_inode(s, ino, meta)
+
+        self._collect(_unlink())
         return 0
 
     def symlink(self, name, target):
         raise NotImplementedError
 
     def rename(self, old, new):
-        meta_key = self._get_meta_key(old)
-        data_key = self._get_data_key(old)
-        new_meta_key = self._get_meta_key(new)
-        new_data_key = self._get_data_key(new)
+        if old == new:
+            return 0
+        if new.startswith(old.rstrip('/') + '/'):
+            # A directory cannot be moved beneath itself.
+            raise FuseOSError(errno.EINVAL)
+        self._validate_path(new)
 
         s = self._get_stm()
 
-        @s.retried_transaction(prefetch_keys=[meta_key, data_key])
+        # Only directory entries and metadata are changed, so the cost does not
+        # depend on the size of a file, or the number of entries beneath a
+        # directory.
+        @s.retried_transaction(seed=lambda s: self._seed_paths(
+            s, os.path.dirname(old), old, os.path.dirname(new), new))
         def _rename(s):
-            meta = Meta.from_json(s.get(meta_key))
-            data = s.get(data_key)
+            old_parent_ino, old_dentry_key, ino = self._resolve_entry(s, old)
+            if ino is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = s.get(self._get_inode_key(ino))
+            if meta is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = Meta.decode(meta)
+            new_parent_ino, new_dentry_key, target_ino = \
+                self._resolve_entry(s, new)
+            if target_ino == ino:
+                # Both are links to the same file.
+                return None
+            gc_key = None
+            target_meta = None
+            if target_ino is not None:
+                target_meta = s.get(self._get_inode_key(target_ino))
+            if target_meta is not None:
+                target_meta = Meta.decode(target_meta)
+                if target_meta.is_dir():
+                    if not meta.is_dir():
+                        raise FuseOSError(errno.EISDIR)
+                    if self._has_entries(target_ino):
+                        raise FuseOSError(errno.ENOTEMPTY)
+                elif meta.is_dir():
+                    raise FuseOSError(errno.ENOTDIR)
+                gc_key = self._unlink_inode(s, target_ino, target_meta)
+            s.delete(old_dentry_key)
+            s.put(new_dentry_key, self._encode_ino(ino))
             meta.touch(ctime=True)
-            s.delete(meta_key)
-            s.delete(data_key)
-            s.put(new_meta_key, meta.to_json())
-            s.put(new_data_key, data)
+            s.put(self._get_inode_key(ino), meta.encode())
+            self._touch_dir(s, old_parent_ino)
+            self._touch_dir(s, new_parent_ino)
+            return gc_key
 
-        _rename()
+        self._collect(_rename())
         return 0
 
-    def link(self, target, name):
-        raise NotImplementedError
+    def link(self, target, source):
+        """Create a hard link at target to the file at source."""
+        self._validate_path(target)
+
+        s = self._get_stm()
+
+        @s.retried_transaction(seed=lambda s: self._seed_paths(
+            s, source, os.path.dirname(target)))
+        def _link(s):
+            ino, meta = self._resolve_meta(s, source)
+            if meta.is_dir():
+                raise FuseOSError(errno.EPERM)
+            parent_ino, dentry_key, existing = self._resolve_entry(s, target)
+            if existing is not None:
+                raise FuseOSError(errno.EEXIST)
+            s.put(dentry_key, self._encode_ino(ino))
+            meta.nlink += 1
+            meta.touch(ctime=True)
+            s.put(self._get_inode_key(ino), meta.encode())
+            self._touch_dir(s, parent_ino)
+
+        _link()
+        return 0
 
     def utimens(self, path, times=None):
         # TODO: update times
         pass
 
+    def _migrate_paths(self):
+        """Move a filesystem stored by path to inodes.
+
+        Filesystems created by earlier versions store metadata under
+        meta/<path>, directory entries under dirent<parent>//<name> and data
+        under data/<path>/<block>, or, before data was split into blocks, as
+        a single value under data/<path>. Files are moved one at a time,
+        parents first, and the root is moved last, so an interrupted
+        migration is resumed by the next mount.
+        """
+        root_meta, _ = self.client.get("meta/")
+        if root_meta is None:
+            return
+        self.logger.warning("Moving filesystem from paths to inodes")
+        txn = self.client.transactions
+        self.client.put(self._get_inode_key(ROOT_INO), root_meta)
+        paths = sorted(("/" + kv.key[len("meta/"):] for _, kv in
+                        self.client.get_prefix("meta/", keys_only=True)),
+                       key=lambda path: path.count("/"))
+        for path in paths:
+            if path == "/":
+                continue
+            value, _ = self.client.get("meta" + path)
+            parent, name = os.path.split(path)
+            parent_ino = self._lookup(parent)
+            ino = self._new_ino()
+            is_dir = Meta.decode(value).is_dir()
+            data_key = "data" + path
+            data_prefix = data_key + "/"
+            if not is_dir:
+                blocks = [(kv.key[len(data_prefix):], data) for data, kv in
+                          self.client.get_prefix(data_prefix)]
+                data, _ = self.client.get(data_key)
+                if data:
+                    blocks.extend(
+                        ("%08x" % block, data[offset:offset + BLOCK_SIZE])
+                        for block, offset in enumerate(
+                            xrange(0, len(data), BLOCK_SIZE)))
+                # Copy a few blocks per transaction, to stay within etcd's
+                # limit on the size of a request.
+                for i in xrange(0, len(blocks), 16):
+                    self.client.transaction(compare=[], success=[
+                        txn.put(self._get_data_key(ino) + block, data)
+                        for block, data in blocks[i:i + 16]], failure=[])
+            ops = [
+                txn.put(self._get_inode_key(ino), value),
+                txn.put(self._get_dentry_key(parent_ino, name),
+                        self._encode_ino(ino)),
+                txn.delete("meta" + path),
+                txn.delete("dirent" + parent.rstrip('/') + "//" + name),
+            ]
+            if not is_dir:
+                # The data of a directory's descendants shares its prefix.
+                ops.append(txn.delete(data_prefix,
+                                      range_end=data_prefix[:-1] + "0"))
+                ops.append(txn.delete(data_key))
+            self.client.transaction(compare=[], success=ops, failure=[])
+        self.client.delete("meta/")
+
+    def _get_format(self):
+        return {"dedup": self.dedup, "block_headers": self.block_headers}
+
+    def _load_format(self):
+        """Use the data format recorded when the filesystem was created."""
+        value, _ = self.client.get(FORMAT_KEY)
+        # Filesystems created before the format was recorded store data in
+        # their blocks, without a header.
+        fmt = json.loads(value) if value else {}
+        dedup = fmt.get("dedup", False)
+        if dedup != self.dedup:
+            self.logger.warning("Filesystem was created with dedup=%s, "
+                                "which overrides the mount option", dedup)
+            self.dedup = dedup
+        self.block_headers = fmt.get("block_headers", False)
+        if not self.block_headers and self.codec != compression.NONE:
+            self.logger.warning("Filesystem was created without compression "
+                                "headers, so data will not be compressed")
+
     # File methods
     # ============
 
     def _ensure_file(self, path, flags, content=""):
+        """Create a file or directory, unless the path exists.
+
+        Returns whether it was created, and the inode number of the path.
+        """
         self._validate_path(path)
         is_dir = (flags & stat.S_IFDIR) == stat.S_IFDIR
         size = 4096 if is_dir else len(content)
@@ -311,137 +1391,368 @@ class EtcdFSV2(LoggingMixIn, Operations):
         meta = Meta(atime=0, ctime=0, gid=gid, mode=flags, mtime=0, nlink=1,
                     size=size, uid=uid)
         meta.touch(atime=True, ctime=True, mtime=True)
-        meta_key = self._get_meta_key(path)
-        data_key = self._get_data_key(path)
-        success = [
-            self.client.transactions.put(meta_key, meta.to_json()),
-        ]
-        compare = [
-            self.client.transactions.create(meta_key) == 0,
-        ]
-        if not is_dir:
-            success.append(self.client.transactions.put(data_key, content))
-            compare.append(self.client.transactions.create(data_key) == 0)
-        created, result = self.client.transaction(
-            compare=compare,
-            success=success,
-            failure=[]
-        )
-
-        if created:
-            parent_path = os.path.dirname(path)
-            parent_meta_key = self._get_meta_key(parent_path)
-
-            s = self._get_stm()
-
-            # FIXME: make consistent
-            @s.retried_transaction()
-            def _update_dir(s):
-                meta = Meta.from_json(s.get(parent_meta_key))
-                meta.touch(ctime=True, mtime=True)
-                s.put(parent_meta_key, meta.to_json())
-
-            _update_dir()
-
-        return created
+        parent, name = os.path.split(path)
+        ino = ROOT_INO if path == '/' else self._new_ino()
+        meta_key = self._get_inode_key(ino)
+
+        def _seed(s):
+            parent_ino, existing = self._seed_paths(s, parent, path)
+            if path == '/':
+                return
+            # The new inode number is assumed to be unused, and checked when
+            # the transaction commits.
+            s.seed(meta_key, None, 0)
+            dentry_key = (self._get_dentry_key(parent_ino, name)
+                          if parent_ino is not None else None)
+            if (existing is None and dentry_key is not None and
+                    self.dentry_cache.get_entry(dentry_key) is None):
+                # Unless the cache says otherwise, assume that the file does
+                # not exist, so that an uncontended create takes a single
+                # round-trip. If it does exist, the commit fails and is
+                # retried with its current entry.
+                s.seed(dentry_key, None, 0)
+
+        s = self._get_stm()
+
+        @s.retried_transaction(seed=_seed)
+        def _create(s):
+            if path == '/':
+                if s.get(meta_key) is not None:
+                    return False, ino
+                s.put(FORMAT_KEY, json.dumps(self._get_format()))
+            else:
+                parent_ino, dentry_key, existing = \
+                    self._resolve_entry(s, path)
+                if existing is not None:
+                    return False, existing
+                s.put(dentry_key, self._encode_ino(ino))
+                self._touch_dir(s, parent_ino)
+            s.put(meta_key, meta.encode())
+            if not is_dir and content:
+                changes = blobs.Changes(self.blobs) if self.dedup else None
+                for block in self._get_blocks(0, len(content)):
+                    self._put_block(
+                        s, self._get_block_key(ino, block),
+                        content[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE],
+                        changes)
+                if changes is not None:
+                    changes.apply(s)
+            return True, ino
+
+        return _create()
 
     def open(self, path, flags):
-        self._ensure_file(path, flags)
-        file = self._create_file(path, flags)
+        # The file usually exists, in which case no transaction is needed.
+        ino = self._lookup(path)
+        if ino is None:
+            _, ino = self._ensure_file(path, flags)
+        file = self._create_file(path, flags, ino)
+        if self.write_locks and flags & (os.O_WRONLY | os.O_RDWR):
+            self._lock_file(file)
         return file.fd
 
     def create(self, path, mode, fi=None):
-        created = self._ensure_file(path, mode)
+        created, ino = self._ensure_file(path, mode)
         if not created:
             raise FuseOSError(errno.EEXIST)
-        file = self._create_file(path, mode)
+        file = self._create_file(path, mode, ino)
+        if self.write_locks:
+            self._lock_file(file)
         return file.fd
 
+    def _lock_file(self, file):
+        try:
+            self._acquire_write_lock(file)
+        except Exception:
+            self._close_file(file.fd)
+            raise
+
+    def _read_cached(self, file, offset, length):
+        """Serve a read from the blocks last fetched by an open file.
+
+        Returns None unless the file's metadata is cached, is unchanged since
+        the blocks were fetched, and its access time need not be updated, in
+        which case no request is needed.
+        """
+        entry = self.meta_cache.get_entry(self._get_inode_key(file.ino))
+        if entry is None or entry[0] is None:
+            return None
+        meta, mod_revision = entry
+        if meta.needs_atime(self.atime):
+            return None
+        with file.lock:
+            if mod_revision != file.read_revision:
+                return None
+            size = max(meta.size, file.get_dirty_end())
+            size = max(min(length, size - offset), 0)
+            blocks = self._get_blocks(offset, size)
+            if any(block not in file.read_blocks for block in blocks):
+                return None
+            data = self._assemble_blocks(file.read_blocks, offset, size)
+            if file.dirty:
+                data = self._overlay_dirty(file, data, offset)
+            file.read_end = offset + size
+            return data
+
     def read(self, path, length, offset, fh):
+        # Open files refer to an inode, so are unaffected by renames.
         file = self._get_file(fh)
-        assert path == file.path
-
-        meta_key = self._get_meta_key(path)
-        data_key = self._get_data_key(file.path)
+        # A file's own buffered writes are applied to the data read, and
+        # those of other open files are committed first, so that reads
+        # include every write buffered by this mount, as getattr does.
+        self._flush_other_files(file)
+        data = self._read_cached(file, offset, length)
+        if data is not None:
+            return data
+
+        meta_key = self._get_inode_key(file.ino)
+        fetch_length = length
+        if self.readahead and offset == file.read_end:
+            # Read ahead of a sequential reader, but not beyond the end of the
+            # file if its size is cached.
+            fetch_length += self.readahead
+            meta = self.meta_cache.get(meta_key)
+            if meta is not None:
+                fetch_length = max(min(fetch_length, meta.size - offset),
+                                   length)
+        blocks = list(self._get_blocks(offset, fetch_length))
+        block_keys = [self._get_block_key(file.ino, block)
+                      for block in blocks]
 
         s = self._get_stm()
 
-        @s.retried_transaction(prefetch_keys=[meta_key, data_key])
+        @s.retried_transaction(prefetch_keys=[meta_key] + block_keys)
         def _read(s):
-            value = s.get(data_key)
-            if value is None:
+            meta = s.get(meta_key)
+            if meta is None:
                 return None
-            meta = Meta.from_json(s.get(meta_key))
-            # Update accessed time.
-            meta.touch(atime=True)
-            s.put(meta_key, meta.to_json())
-            # FIXME: Read only up to end?
-            return value[offset:offset+length]
+            meta = Meta.decode(meta)
+            if meta.needs_atime(self.atime):
+                # Update accessed time.
+                meta.touch(atime=True)
+                s.put(meta_key, meta.encode())
+            with file.lock:
+                # Read only up to the end of the file, including buffered
+                # writes.
+                size = max(meta.size, file.get_dirty_end())
+                size = max(min(length, size - offset), 0)
+                contents = self._load_blocks(s, file.ino, blocks)
+                data = self._assemble_blocks(contents, offset, size)
+                if file.dirty:
+                    data = self._overlay_dirty(file, data, offset)
+                return data, contents
+
+        result = _read()
+        if result is None:
+            return None
+        data, contents = result
+        with file.lock:
+            file.read_blocks = contents
+            # If the access time was updated, the metadata was modified by
+            # the commit.
+            file.read_revision = (s.commit_revision or
+                                  s.get_mod_revision(meta_key))
+            file.read_end = offset + len(data)
+        return data
 
-        return _read()
+    @staticmethod
+    def _overlay_dirty(file, data, offset):
+        """Apply an open file's buffered writes to data read at offset."""
+        data = bytearray(data)
+        end = offset + len(data)
+        for extent_offset, buf in file.get_dirty():
+            start = max(offset, extent_offset)
+            stop = min(end, extent_offset + len(buf))
+            if start < stop:
+                data[start - offset:stop - offset] = \
+                    buf[start - extent_offset:stop - extent_offset]
+        return str(data)
 
     def write(self, path, buf, offset, fh):
         # Handle get/update/put
         file = self._get_file(fh)
-        assert path == file.path
-
-        meta_key = self._get_meta_key(path)
-        data_key = self._get_data_key(path)
-
-        s = self._get_stm()
-
-        @s.retried_transaction(prefetch_keys=[meta_key, data_key])
-        def _write(s):
-            meta = Meta.from_json(s.get(meta_key))
-            data = s.get(data_key)
-            # Update size and modified times.
-            meta.size = max(meta.size, offset + len(buf))
-            meta.touch(atime=True, ctime=True, mtime=True)
-            data = data[:offset] + buf + data[offset + len(buf):]
-            s.put(meta_key, meta.to_json())
-            s.put(data_key, data)
 
-        _write()
+        if file.write_lock is not None:
+            self._check_write_lock(file)
+        elif not self.writeback:
+            if not self._commit_extents(file.ino, [(offset, buf)]):
+                raise FuseOSError(errno.ENOENT)
+            return len(buf)
+
+        with file.lock:
+            file.buffer_write(offset, buf)
+            with self.fds_lock:
+                self.dirty_files.setdefault(file.ino, set()).add(file)
+            if (file.dirty_size >= self.writeback_size or
+                    len(file.dirty_blocks) >= FLUSH_BLOCKS):
+                self._flush_file(file)
         return len(buf)
 
     def truncate(self, path, length, fh=None):
-        meta_key = self._get_meta_key(path)
-        data_key = self._get_data_key(path)
+        if fh is not None:
+            ino = self._get_file(fh).ino
+        else:
+            ino = self._lookup(path)
+            if ino is None:
+                raise FuseOSError(errno.ENOENT)
+        # Buffered writes must not extend the file after truncation.
+        self._flush_inode(ino)
+        meta_key = self._get_inode_key(ino)
+        block_keys = []
+        if length % BLOCK_SIZE:
+            # The new last block may need to be trimmed.
+            block_keys.append(self._get_block_key(ino, length // BLOCK_SIZE))
 
         s = self._get_stm()
 
-        @s.retried_transaction(prefetch_keys=[meta_key, data_key])
+        @s.retried_transaction(prefetch_keys=[meta_key] + block_keys)
         def _truncate(s):
-            meta = Meta.from_json(s.get(meta_key))
-            data = s.get(data_key)
+            meta = s.get(meta_key)
+            if meta is None:
+                raise FuseOSError(errno.ENOENT)
+            meta = Meta.decode(meta)
+            gc_key = self._truncate_blocks(s, ino, meta.size, length)
             # Update size and modified times.
             meta.size = length
             meta.touch(atime=True, ctime=True, mtime=True)
-            if len(data) >= length:
-                data = data[:length]
-            else:
-                data = data + "\0" * (length - len(data))
-            s.put(meta_key, meta.to_json())
-            s.put(data_key, data)
+            s.put(meta_key, meta.encode())
+            return gc_key
 
-        _truncate()
+        self._collect(_truncate())
         return 0
 
     def flush(self, path, fh):
-        # Not required as FS is synchronous.
-        pass
+        # Only required in write-back mode, otherwise FS is synchronous.
+        self._flush_file(self._get_file(fh))
 
     def release(self, path, fh):
-        self._close_file(fh)
+        file = self._get_file(fh)
+        try:
+            self._flush_file(file)
+        finally:
+            if file.write_lock is not None:
+                self._release_write_lock(file)
+            self._close_file(fh)
 
     def fsync(self, path, fdatasync, fh):
-        # Not required as FS is synchronous.
-        pass
-
-
-def main(mountpoint):
-    FUSE(EtcdFSV2(), mountpoint, nothreads=True, foreground=True, allow_other=True)
+        # Only required in write-back mode, otherwise FS is synchronous.
+        self._flush_file(self._get_file(fh))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="FUSE filesystem backed by etcd")
+    parser.add_argument("mountpoint")
+    parser.add_argument("--endpoints", type=pool.parse_endpoints,
+                        default=DEFAULT_ENDPOINTS,
+                        help="comma separated host:port of each etcd "
+                             "member. Requests are spread over the members, "
+                             "and fail over between them")
+    parser.add_argument("--etcd-timeout", type=float, default=ETCD_TIMEOUT,
+                        help="seconds after which an etcd request fails")
+    parser.add_argument("--threads", action="store_true",
+                        help="handle filesystem requests in parallel")
+    parser.add_argument("--writeback", action="store_true",
+                        help="buffer writes to each open file until it is "
+                             "flushed, synced or closed")
+    parser.add_argument("--writeback-size", type=int, default=WRITEBACK_SIZE,
+                        help="maximum number of bytes buffered per open file "
+                             "in write-back mode")
+    parser.add_argument("--atime", choices=ATIME_POLICIES,
+                        default=ATIME_RELATIME,
+                        help="when reads update the access time of a file")
+    parser.add_argument("--retry-attempts", type=int,
+                        default=stm.DEFAULT_RETRY_POLICY.attempts,
+                        help="maximum attempts of a conflicting transaction")
+    parser.add_argument("--retry-budget", type=float,
+                        default=stm.DEFAULT_RETRY_POLICY.budget,
+                        help="maximum time in seconds spent retrying a "
+                             "conflicting transaction")
+    parser.add_argument("--isolation", choices=stm.ISOLATION_LEVELS,
+                        default=stm.SERIALIZABLE_SNAPSHOT,
+                        help="isolation level of transactions")
+    parser.add_argument("--log-level", default="DEBUG",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of messages to log. At DEBUG, every "
+                             "filesystem operation is logged")
+    parser.add_argument("--log-file", default="fuse-etcd-v2.log",
+                        help="file to log to")
+    parser.add_argument("--fake-etcd", action="store_true",
+                        help="store the filesystem in an in-memory etcd "
+                             "stand-in, for testing and benchmarking")
+    parser.add_argument("--fake-etcd-latency", type=float, default=0,
+                        help="seconds of latency added to each request to "
+                             "the in-memory etcd stand-in")
+    parser.add_argument("--meta-cache-size", type=int,
+                        default=META_CACHE_SIZE,
+                        help="maximum number of cached metadata entries, "
+                             "and of cached directory entries, or 0 to "
+                             "disable the caches")
+    parser.add_argument("--readahead", type=int, default=READAHEAD_SIZE,
+                        help="number of bytes read ahead of sequential reads "
+                             "of each open file, or 0 to disable")
+    parser.add_argument("--dedup", action="store_true",
+                        help="store each distinct block of data once, when "
+                             "creating a new filesystem")
+    parser.add_argument("--blob-cache-size", type=int,
+                        default=BLOB_CACHE_SIZE,
+                        help="maximum number of bytes of cached blobs in "
+                             "deduplication mode")
+    parser.add_argument("--compression", choices=sorted(compression.CODECS),
+                        default=compression.NONE,
+                        help="codec used to compress data when it is "
+                             "written")
+    parser.add_argument("--batch-reads", action="store_true",
+                        help="combine reads of single keys by concurrent "
+                             "operations into one request")
+    parser.add_argument("--batch-window", type=float, default=0,
+                        help="seconds to wait for more reads before sending "
+                             "a batch of reads")
+    parser.add_argument("--write-locks", action="store_true",
+                        help="lock files open for writing, so that writers "
+                             "through other mounts wait rather than "
+                             "conflict")
+    parser.add_argument("--write-lock-ttl", type=int, default=WRITE_LOCK_TTL,
+                        help="seconds after which a write lock is released "
+                             "if the file is not written to")
+    parser.add_argument("--entry-timeout", type=float, default=ENTRY_TIMEOUT,
+                        help="seconds for which the kernel caches directory "
+                             "entries")
+    parser.add_argument("--negative-timeout", type=float,
+                        default=NEGATIVE_TIMEOUT,
+                        help="seconds for which the kernel caches lookups of "
+                             "paths which do not exist, or 0 to disable")
+    return parser.parse_args()
+
+
+def main(args):
+    logging.basicConfig(filename=args.log_file, filemode='w',
+                        level=getattr(logging, args.log_level))
+    client = None
+    if args.fake_etcd:
+        client = fake_etcd.client(latency=args.fake_etcd_latency)
+    fs = EtcdFSV2(meta_cache_size=args.meta_cache_size,
+                  writeback=args.writeback,
+                  writeback_size=args.writeback_size,
+                  atime=args.atime,
+                  retry_policy=stm.RetryPolicy(attempts=args.retry_attempts,
+                                               budget=args.retry_budget),
+                  isolation=args.isolation,
+                  client=client,
+                  dedup=args.dedup,
+                  blob_cache_size=args.blob_cache_size,
+                  codec=args.compression,
+                  readahead=args.readahead,
+                  batch_reads=args.batch_reads,
+                  batch_window=args.batch_window,
+                  endpoints=args.endpoints,
+                  timeout=args.etcd_timeout,
+                  write_locks=args.write_locks,
+                  write_lock_ttl=args.write_lock_ttl)
+    FUSE(fs, args.mountpoint, nothreads=not args.threads, foreground=True,
+         allow_other=True, use_ino=True, entry_timeout=args.entry_timeout,
+         negative_timeout=args.negative_timeout)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main(parse_args())
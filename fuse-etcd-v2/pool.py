@@ -0,0 +1,178 @@
+"""A pool of etcd clients, one per member of a cluster, with failover.
+
+The pool has the interface of a single etcd3 client. Each request is sent to
+the next healthy member in turn, so that load is spread across the cluster,
+and any member may serve any request: etcd forwards writes to the leader.
+"""
+
+import itertools
+import logging
+import threading
+
+import etcd3
+import grpc
+
+
+LOG = logging.getLogger(__name__)
+
+# Default interval in seconds between checks of unhealthy members.
+HEALTH_INTERVAL = 1.0
+
+# Requests which only read, and so may be retried on another member if they
+# fail to connect. Other requests may have been applied, so are not retried.
+READ_METHODS = frozenset([
+    'get', 'get_response', 'get_range', 'get_range_response',
+    'get_range_responses', 'get_prefix', 'get_prefix_response', 'get_all',
+    'Range',
+])
+
+# Errors of a member which is unreachable, or which has lost its leader.
+CONNECTION_ERRORS = (etcd3.exceptions.ConnectionFailedError,
+                     etcd3.exceptions.ConnectionTimeoutError)
+UNAVAILABLE_CODES = (grpc.StatusCode.UNAVAILABLE,
+                     grpc.StatusCode.DEADLINE_EXCEEDED)
+
+
+def parse_endpoints(endpoints):
+    """Return (host, port) for each endpoint of a comma separated list."""
+    result = []
+    for endpoint in endpoints.split(","):
+        host, _, port = endpoint.strip().rpartition(":")
+        result.append((host or "localhost", int(port)))
+    return result
+
+
+def client(endpoints, **kwargs):
+    """Return a client for a list of (host, port) endpoints.
+
+    With a single endpoint this is an etcd3 client, otherwise a ClientPool.
+    Keyword arguments are passed to etcd3.client.
+    """
+    clients = [etcd3.client(host=host, port=port, **kwargs)
+               for host, port in endpoints]
+    if len(clients) == 1:
+        return clients[0]
+    return ClientPool(clients)
+
+
+class ClientPool(object):
+    """Sends requests to a pool of clients, failing over between them.
+
+    A client is marked unhealthy when a request to it fails to connect, and
+    is no longer used until a background check, every `health_interval`
+    seconds, finds that it serves reads again. If every client is unhealthy,
+    all are tried. Watches are not moved when their member fails, but end, so
+    that they are re-established by the caller on another member.
+    """
+
+    def __init__(self, clients, health_interval=HEALTH_INTERVAL):
+        self.clients = list(clients)
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.unhealthy = set()
+        self.counter = itertools.count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._check_health)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getattr__(self, name):
+        # Only called for attributes not set on the pool.
+        if name.endswith('stub'):
+            if not hasattr(self.clients[0], name):
+                raise AttributeError(name)
+            return _Stub(self, name)
+        value = getattr(self.clients[0], name)
+        if name.startswith('_') or not callable(value):
+            # Configuration and request builders, which are the same for
+            # every client.
+            return value
+        return _Method(self, lambda client: getattr(client, name), name,
+                       CONNECTION_ERRORS)
+
+    def close(self):
+        self.stopped.set()
+        for client in self.clients:
+            client.close()
+
+    def _pick(self, exclude=()):
+        """Return the next healthy client not in exclude, or None."""
+        with self.lock:
+            candidates = [client for client in self.clients
+                          if client not in exclude and
+                          client not in self.unhealthy]
+            if not candidates:
+                candidates = [client for client in self.clients
+                              if client not in exclude]
+        if not candidates:
+            return None
+        return candidates[next(self.counter) % len(candidates)]
+
+    def _mark_unhealthy(self, client, error):
+        with self.lock:
+            if client in self.unhealthy:
+                return
+            self.unhealthy.add(client)
+        LOG.warning("etcd endpoint %d is unhealthy: %s",
+                    self.clients.index(client), error)
+
+    def _call(self, get_method, name, errors, args, kwargs):
+        tried = []
+        while True:
+            client = self._pick(exclude=tried)
+            try:
+                return get_method(client)(*args, **kwargs)
+            except errors as e:
+                if (isinstance(e, grpc.RpcError) and
+                        e.code() not in UNAVAILABLE_CODES):
+                    raise
+                self._mark_unhealthy(client, e)
+                tried.append(client)
+                if (name not in READ_METHODS or
+                        len(tried) == len(self.clients)):
+                    raise
+
+    def _check_health(self):
+        while not self.stopped.wait(self.health_interval):
+            with self.lock:
+                unhealthy = list(self.unhealthy)
+            for client in unhealthy:
+                try:
+                    client.get_response("health", serializable=True)
+                except Exception:
+                    continue
+                with self.lock:
+                    self.unhealthy.discard(client)
+                LOG.info("etcd endpoint %d is healthy",
+                         self.clients.index(client))
+
+
+class _Method(object):
+
+    def __init__(self, pool, get_method, name, errors):
+        self.pool = pool
+        self.get_method = get_method
+        self.name = name
+        self.errors = errors
+
+    def __call__(self, *args, **kwargs):
+        return self.pool._call(self.get_method, self.name, self.errors, args,
+                               kwargs)
+
+
+class _Stub(object):
+    """A gRPC stub whose methods are called on a client of the pool."""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def __getattr__(self, method):
+        method = _Method(
+            self.pool,
+            lambda client: getattr(getattr(client, self.name), method),
+            method, grpc.RpcError)
+        method.future = lambda *args, **kwargs: getattr(
+            getattr(self.pool._pick(), self.name), method.name).future(
+                *args, **kwargs)
+        return method
@@ -0,0 +1,138 @@
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+
+class Histogram(object):
+    """Histogram with exponentially sized buckets.
+
+    Bucket i counts values greater than bounds[i - 1] and no greater than
+    bounds[i], where bounds[i] is base * factor ** i. A final bucket counts
+    values greater than the last bound. Histograms are not thread safe.
+    """
+
+    def __init__(self, base=1e-6, factor=2, size=32):
+        self.bounds = [base * factor ** i for i in range(size)]
+        self.counts = [0] * (size + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Return an upper bound on the given percentile of values."""
+        if not self.count:
+            return 0
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.sum / float(self.count) if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": [(bound, count)
+                        for bound, count in zip(self.bounds + [None],
+                                                self.counts)
+                        if count],
+        }
+
+
+class Operation(object):
+    """Statistics for one kind of operation."""
+
+    def __init__(self):
+        self.errors = 0
+        self.latency = Histogram()
+        self.rpcs = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def to_dict(self):
+        return {
+            "errors": self.errors,
+            "latency": self.latency.to_dict(),
+            "rpcs": self.rpcs,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class OperationStats(object):
+    """Latency and etcd requests of each kind of operation.
+
+    Operations are timed using the operation() context manager, and etcd
+    requests made by the same thread during an operation are attributed to
+    it. Requests made outside any operation, for example by background
+    threads, are attributed to BACKGROUND. Thread safe.
+    """
+
+    BACKGROUND = "background"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.operations = collections.defaultdict(Operation)
+        # Number of requests of each etcd method.
+        self.rpcs = collections.Counter()
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        self.local.operation = name
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            latency = time.time() - start
+            self.local.operation = None
+            with self.lock:
+                operation = self.operations[name]
+                operation.latency.add(latency)
+                operation.errors += failed
+
+    def iterate(self, name, iterable):
+        """Yield the items of an iterable, measured as an operation.
+
+        This is for operations such as readdir which return a generator, and
+        so do their work as they are iterated.
+        """
+        with self.operation(name):
+            for item in iterable:
+                yield item
+
+    def record_rpc(self, method, bytes_sent, bytes_received):
+        name = getattr(self.local, "operation", None) or self.BACKGROUND
+        with self.lock:
+            operation = self.operations[name]
+            operation.rpcs += 1
+            operation.bytes_sent += bytes_sent
+            operation.bytes_received += bytes_received
+            self.rpcs[method] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "operations": dict((name, operation.to_dict())
+                                   for name, operation
+                                   in self.operations.items()),
+                "rpcs": dict(self.rpcs),
+            }
@@ -1,40 +1,215 @@
+import collections
 import contextlib
 import functools
+import itertools
 import json
+import logging
+import random
+import sys
+import threading
 import time
 
 import etcd3
 
+import etcdclient
+import stats
+
+
+LOG = logging.getLogger(__name__)
+
+# etcd limits a transaction to 128 operations by default.
+MAX_TXN_OPS = 128
+
 
 class Conflict(Exception):
-    pass
+
+    def __init__(self, keys=()):
+        super(Conflict, self).__init__(keys)
+        # Keys which were modified since they were read.
+        self.keys = keys
 
 
 class AlreadyInTransaction(Exception):
     pass
 
 
+class RetryPolicy(object):
+    """How STM transactions are retried after a conflict.
+
+    A transaction is attempted at most `attempts` times. A failed commit
+    refreshes the read set, so the first retry is immediate. Before later
+    attempts, it sleeps for a random time between zero and an exponentially
+    increasing limit (full jitter), starting at `initial` seconds, multiplied
+    by `multiplier` after each attempt, and capped at `maximum` seconds. If
+    `budget` is set, the transaction is abandoned rather than retried once
+    it would take longer than `budget` seconds in total.
+    """
+
+    def __init__(self, attempts=100, initial=0.001, maximum=0.1, multiplier=2,
+                 budget=10):
+        self.attempts = attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.budget = budget
+
+    def get_delay(self, attempt):
+        """Return how long to sleep after the given failed attempt."""
+        if attempt < 2:
+            return 0
+        limit = min(self.maximum,
+                    self.initial * self.multiplier ** (attempt - 2))
+        return random.uniform(0, limit)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class Metrics(object):
+    """Counters and histograms describing STM transactions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # Transactions which committed, and which ran out of attempts.
+            self.transactions = 0
+            self.failures = 0
+            # Number of attempts per transaction.
+            self.attempts = stats.Histogram(base=1)
+            # Number of conflicts per key.
+            self.conflicts = collections.Counter()
+            # Latency of commit requests, in seconds.
+            self.commit_latency = stats.Histogram()
+
+    def record_transaction(self, attempts, failed=False):
+        with self.lock:
+            if failed:
+                self.failures += 1
+            else:
+                self.transactions += 1
+            self.attempts.add(attempts)
+
+    def record_commit(self, latency, conflicts=()):
+        with self.lock:
+            self.commit_latency.add(latency)
+            self.conflicts.update(conflicts)
+
+    def to_dict(self, top=10):
+        """Return a snapshot of the metrics, with the most contended keys."""
+        with self.lock:
+            return {
+                "transactions": self.transactions,
+                "failures": self.failures,
+                "attempts": self.attempts.to_dict(),
+                "conflicts": self.conflicts.most_common(top),
+                "commit_latency": self.commit_latency.to_dict(),
+            }
+
+
+# Metrics for all STMs which are not given their own.
+METRICS = Metrics()
+
+
+# Isolation levels. With repeatable reads, each key is read at the latest
+# revision when first accessed. With serializable snapshot isolation, all keys
+# are read at the revision of the first read, so a transaction never sees a
+# mix of old and new values, and blind writes also conflict with changes
+# made since that revision.
+REPEATABLE_READS = "repeatable-reads"
+SERIALIZABLE_SNAPSHOT = "serializable-snapshot"
+ISOLATION_LEVELS = (REPEATABLE_READS, SERIALIZABLE_SNAPSHOT)
+
+
 class STM(object):
-    """Software Transactional Memory (STM) using etcd."""
+    """Software Transactional Memory (STM) using etcd.
 
-    def __init__(self, client):
+    Reads are tracked in a read set, and writes are buffered in a write set
+    until commit. A transaction which writes is committed with a single etcd
+    transaction, which checks that no key in the read set has changed. A
+    transaction which only reads, and whose reads were all served at a single
+    revision, observed a consistent snapshot and so needs no commit.
+    """
+
+    def __init__(self, client, on_commit=None, retry_policy=None,
+                 metrics=None, isolation=REPEATABLE_READS, batcher=None):
         self.client = client
+        # If set, a batcher.Batcher through which single key reads are sent,
+        # so that they may share a request with reads by other threads.
+        self.batcher = batcher
+        # Called with the STM after a successful commit.
+        self.on_commit = on_commit
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self.metrics = metrics or METRICS
+        self.isolation = isolation
         self.rset = {}
         self.wset = {}
+        self.drset = []
+        # Maps each key read from etcd to its mod_revision, or 0 if it did
+        # not exist.
         self.conflicts = {}
+        # Number of etcd requests used to populate the read set.
+        self.read_requests = 0
+        # Revisions at which reads were served. None means unknown.
+        self.read_revisions = set()
+        # Revision to which reads are pinned with snapshot isolation.
+        self.revision = None
+        # Revision of the last successful commit which wrote.
+        self.commit_revision = None
+        self.active = False
+
+    def _is_snapshot(self):
+        return self.isolation == SERIALIZABLE_SNAPSHOT
+
+    def _record_read(self, key, value, kv):
+        self.rset[key] = value, kv
+        self.conflicts[key] = kv.mod_revision if kv is not None else 0
+
+    def _record_revision(self, revision):
+        self.read_requests += 1
+        self.read_revisions.add(revision)
+        if self._is_snapshot() and self.revision is None:
+            self.revision = revision
 
     def get(self, key):
         if key in self.rset:
             return self.rset[key][0]
-        value, kv = self.client.get(key)
-        self.rset[key] = value, kv
-        if value is not None:
-            self.conflicts[key] = kv
+        if self._in_deleted_range(key):
+            return None
+        # Without snapshot isolation, revision is None, and the latest value is
+        # read.
+        if self.batcher is not None:
+            response = self.batcher.get_response(key, self.revision)
         else:
-            # TODO: check that key still does not exist?
-            pass
+            response = etcdclient.get_range_response(self.client, key,
+                                                     revision=self.revision)
+        self._record_revision(self.revision or response.header.revision)
+        kv = response.kvs[0] if response.kvs else None
+        value = kv.value if kv is not None else None
+        self._record_read(key, value, kv)
         return value
 
+    def seed(self, key, value, mod_revision):
+        """Add a value read elsewhere, such as from a cache, to the read set.
+
+        mod_revision is that of the value, or 0 if the key does not exist.
+        Like any read, a seeded value is checked when the transaction
+        commits, so it is only validated if the transaction writes, or reads
+        from etcd at more than one revision.
+        """
+        if key not in self.rset:
+            self.rset[key] = value, None
+            self.conflicts[key] = mod_revision
+
+    def get_mod_revision(self, key):
+        """Return the mod_revision of a key in the read set.
+
+        This is 0 if the key did not exist, or None if it has not been read.
+        """
+        return self.conflicts.get(key)
+
     def put(self, key, value):
         self.wset[key] = value
         self.rset[key] = value, None
@@ -42,84 +217,200 @@ class STM(object):
     def delete(self, key):
         self.put(key, None)
 
+    def delete_range(self, start, end):
+        """Delete all keys in the range [start, end).
+
+        Keys in the range must not also be put in the same transaction, since
+        etcd rejects transactions with overlapping operations.
+        """
+        self.drset.append((start, end))
+
+    def _in_deleted_range(self, key):
+        return any(start <= key < end for start, end in self.drset)
+
     @contextlib.contextmanager
-    def transaction(self, prefetch_keys=None):
-        if self.conflicts:
-            raise AlreadyInTranscation()
+    def transaction(self, prefetch_keys=None, seed=None):
+        """Run a transaction, committing it on exit.
 
-        if prefetch_keys:
-            self.prefetch(prefetch_keys)
+        If seed is set, it is called with the STM first, to seed the read set
+        with values read elsewhere, such as from a cache.
+        """
+        # The read set may already be populated with the current values of
+        # keys that conflicted in a previous attempt.
+        if self.active:
+            raise AlreadyInTransaction()
+
+        self.active = True
         try:
-            yield self
-        except:
-            self.reset()
-            raise
-        else:
-            self.commit()
+            if seed is not None:
+                seed(self)
+            if prefetch_keys:
+                self.prefetch(prefetch_keys)
+            try:
+                yield self
+            except:
+                self.reset()
+                raise
+            else:
+                self.commit()
+        finally:
+            self.active = False
 
     def prefetch(self, prefetch_keys):
         to_fetch = set(prefetch_keys) - set(self.rset)
         if not to_fetch:
             return
 
-        success = [self.client.transactions.get(key) for key in to_fetch]
+        if self.revision is not None:
+            # Transactions cannot read at a past revision, so read each key
+            # at the pinned revision, with the requests pipelined.
+            to_fetch = sorted(to_fetch)
+            responses = etcdclient.get_many_responses(self.client, to_fetch,
+                                                      revision=self.revision)
+            self._record_revision(self.revision)
+            for key, response in zip(to_fetch, responses):
+                kv = response.kvs[0] if response.kvs else None
+                self._record_read(key, kv.value if kv is not None else None,
+                                  kv)
+            return
+
+        # Keys beyond the limit of a transaction are read by a recursive
+        # call, at the revision of the first batch with snapshot isolation.
+        to_fetch = sorted(to_fetch)
+        batch, rest = to_fetch[:MAX_TXN_OPS], to_fetch[MAX_TXN_OPS:]
+        success = [self.client.transactions.get(key) for key in batch]
         success, result = self.client.transaction(compare=[],
                                                   success=success,
                                                   failure=[])
-        for value, kv in result[0]:
-            self.rset[kv.key] = value, kv
-            if value is not None:
-                self.conflicts[kv.key] = kv
         assert success
+        self._record_responses(batch, result)
+        if rest:
+            self.prefetch(rest)
+
+    def _record_responses(self, keys, result):
+        """Record the results of a transaction of gets in the read set."""
+        revision = None
+        for response in result:
+            for value, kv in response:
+                self._record_read(kv.key, value, kv)
+                revision = kv.response_header.revision
+        # Keys which were not returned do not exist.
+        for key in keys:
+            if key not in self.conflicts:
+                self._record_read(key, None, None)
+        # The revision of the transaction is only known if it returned a key.
+        self._record_revision(revision)
 
     def reset(self):
         self.rset = {}
         self.wset = {}
+        self.drset = []
         self.conflicts = {}
+        self.read_requests = 0
+        self.read_revisions = set()
+        self.revision = None
+
+    def is_read_only(self):
+        return not self.wset and not self.drset
+
+    def is_consistent(self):
+        """Return whether all reads were served at a single revision."""
+        return (self.read_requests <= 1 or
+                len(self.read_revisions) == 1 and
+                None not in self.read_revisions)
 
     def commit(self):
+        if self.is_read_only() and self.is_consistent():
+            # All reads observed a single revision, so they are consistent,
+            # and there is nothing to write.
+            return
+
         compare = []
         success = []
         failure = []
-        for key, kv in self.conflicts.items():
-            compare.append(self.client.transactions.version(key) == kv.version)
+        for key, mod_revision in self.conflicts.items():
+            compare.append(
+                self.client.transactions.mod(key) == mod_revision)
+        if self._is_snapshot() and self.revision is not None:
+            for key in self.wset:
+                if key not in self.conflicts:
+                    compare.append(
+                        self.client.transactions.mod(key) < self.revision + 1)
+        for start, end in self.drset:
+            success.append(self.client.transactions.delete(start,
+                                                           range_end=end))
         for key, value in self.wset.items():
             if value is None:
                 success.append(self.client.transactions.delete(key))
             else:
                 success.append(self.client.transactions.put(key, value))
-        for key, value in self.rset.items():
+        keys = set(self.conflicts) | set(self.wset)
+        for key in keys:
             failure.append(self.client.transactions.get(key))
 
+        start = time.time()
         success, result = self.client.transaction(compare=compare,
                                                   success=success,
                                                   failure=failure)
+        latency = time.time() - start
 
         if not success:
+            conflicts = self.conflicts
+            revision = self.revision
             self.reset()
             # Populate read set and conflicts with current value of all reads.
-            for value, kv in result[0]:
-                self.rset[kv.key] = value, kv
-                self.conflicts[kv.key] = kv
-            raise Conflict()
+            self._record_responses(keys, result)
+            changed = [key for key in keys
+                       if key in conflicts and
+                       conflicts[key] != self.conflicts[key] or
+                       key not in conflicts and revision is not None and
+                       self.conflicts[key] > revision]
+            self.metrics.record_commit(latency, changed)
+            raise Conflict(changed)
+
+        self.metrics.record_commit(latency)
+        # Each put and delete response holds the revision of the commit.
+        self.commit_revision = max([
+            max(response.response_put.header.revision,
+                response.response_delete_range.header.revision)
+            for response in result] or [None])
+
+        if self.on_commit:
+            self.on_commit(self)
 
-    def retried_transaction(self, retries=10, interval=0, *args, **kwargs):
+    def retried_transaction(self, retry_policy=None, *args, **kwargs):
+        policy = retry_policy or self.retry_policy
 
         def _decorator(func):
 
             @functools.wraps(func)
             def _retried():
-                for attempt in range(retries):
+                start = time.time()
+                for attempt in itertools.count(1):
                     try:
                         with self.transaction(*args, **kwargs):
-                            return func(self)
-                    except Conflict:
-                        if attempt == retries - 1:
+                            result = func(self)
+                    except Conflict as e:
+                        delay = policy.get_delay(attempt)
+                        elapsed = time.time() - start + delay
+                        if (attempt >= policy.attempts or
+                                policy.budget is not None and
+                                elapsed > policy.budget):
+                            self.metrics.record_transaction(attempt,
+                                                            failed=True)
                             raise
-                        print "got conflict, retrying"
-                        if interval:
-                            time.sleep(interval)
-                        continue
+                        LOG.debug("Conflict on %s, retrying in %.3fs",
+                                  e.keys, delay)
+                        if delay:
+                            time.sleep(delay)
+                            # Values read by the failed commit may now be
+                            # stale. The read set is seeded again, if the
+                            # transaction has a seed, so the next attempt
+                            # need not read every key from etcd again.
+                            self.reset()
+                    else:
+                        self.metrics.record_transaction(attempt)
+                        return result
 
             return _retried
 
@@ -127,8 +418,14 @@ class STM(object):
 
 
 if __name__ == "__main__":
+    # Pass --fake to use an in-memory etcd stand-in.
+    if "--fake" in sys.argv[1:]:
+        import fake_etcd
+        client = fake_etcd.client()
+    else:
+        client = etcd3.client()
     while True:
-        stm = STM(etcd3.client())
+        stm = STM(client)
 
         @stm.retried_transaction(prefetch_keys=['counter'])
         def increment(stm):
@@ -0,0 +1,1125 @@
+#!/usr/bin/env python
+
+"""Hermetic tests using the in-memory etcd stand-in.
+
+Unlike test-fuse-etcd-v2.py, these need neither an etcd server nor a mount,
+as the filesystem methods are called directly.
+"""
+
+import errno
+import imp
+import json
+import os
+import stat
+import threading
+import time
+import unittest
+
+import etcd3
+import etcd3.etcdrpc as etcdrpc
+from fuse import FuseOSError
+import grpc
+
+import batcher
+import etcdclient
+import fake_etcd
+import pool
+import stats
+import stm
+
+
+def _load(name, path):
+    return imp.load_source(name, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), path))
+
+
+fuse_etcd = _load("fuse_etcd", "../fuse-etcd/fuse-etcd.py")
+fuse_etcd_v2 = _load("fuse_etcd_v2", "fuse-etcd-v2.py")
+
+
+class TestFakeEtcd(unittest.TestCase):
+
+    def setUp(self):
+        super(TestFakeEtcd, self).setUp()
+        self.client = fake_etcd.client()
+
+    def test_get_put_delete(self):
+        self.assertEqual((None, None), self.client.get("a"))
+        self.client.put("a", "1")
+        value, kv = self.client.get("a")
+        self.assertEqual("1", value)
+        self.assertEqual(1, kv.version)
+        self.assertTrue(self.client.delete("a"))
+        self.assertEqual((None, None), self.client.get("a"))
+        self.assertFalse(self.client.delete("a"))
+
+    def test_revisions(self):
+        revision = self.client.revision
+        self.client.put("a", "1")
+        self.client.put("a", "2")
+        _, kv = self.client.get("a")
+        self.assertEqual(revision + 1, kv.create_revision)
+        self.assertEqual(revision + 2, kv.mod_revision)
+        self.assertEqual(2, kv.version)
+        response = self.client.get_range_response("a", None,
+                                                  revision=revision + 1)
+        self.assertEqual(["1"], [kv.value for kv in response.kvs])
+
+    def test_get_prefix(self):
+        for key in ("a/1", "a/2", "b/1"):
+            self.client.put(key, key)
+        self.assertEqual(["a/1", "a/2"],
+                         [v for v, _ in self.client.get_prefix("a/")])
+
+    def test_transaction(self):
+        self.client.put("a", "1")
+        txn = self.client.transactions
+        succeeded, _ = self.client.transaction(
+            compare=[txn.version("a") == 1, txn.create("b") == 0],
+            success=[txn.put("a", "2"), txn.put("b", "1")],
+            failure=[])
+        self.assertTrue(succeeded)
+        succeeded, responses = self.client.transaction(
+            compare=[txn.version("a") == 1],
+            success=[txn.put("a", "3")],
+            failure=[txn.get("a")])
+        self.assertFalse(succeeded)
+        self.assertEqual("2", responses[0][0][0])
+
+    def test_transaction_limits(self):
+        txn = self.client.transactions
+        self.assertRaises(
+            etcd3.exceptions.Etcd3Exception, self.client.transaction,
+            compare=[], success=[txn.put("k%d" % i, "")
+                                 for i in range(fake_etcd.MAX_TXN_OPS + 1)],
+            failure=[])
+        self.assertRaises(
+            etcd3.exceptions.Etcd3Exception, self.client.transaction,
+            compare=[], success=[txn.put("k", "a" * (2 * 1024 * 1024))],
+            failure=[])
+
+    def test_watch_prefix(self):
+        revision = self.client.revision
+        self.client.put("a/1", "1")
+        self.client.delete("a/1")
+        self.client.put("b/1", "1")
+        events, cancel = self.client.watch_prefix("a/",
+                                                  start_revision=revision)
+        self.assertEqual("1", next(events).value)
+        self.assertEqual("a/1", next(events).key)
+        cancel()
+
+    def test_latency(self):
+        self.client.latency = 0.01
+        start = time.time()
+        self.client.get("a")
+        self.assertGreaterEqual(time.time() - start, 0.01)
+        self.assertEqual(1, self.client.rpcs["range"])
+
+
+class _FakeClock(object):
+    """Stands in for the time module, advancing only when slept."""
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class _UpperBound(object):
+    """Stands in for the random module, always choosing the upper bound."""
+
+    def uniform(self, a, b):
+        return b
+
+
+class TestSTM(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSTM, self).setUp()
+        self.client = fake_etcd.client(latency=0.001)
+
+    def _fake_clock(self):
+        clock = _FakeClock()
+        self.addCleanup(setattr, stm, "time", stm.time)
+        stm.time = clock
+        return clock
+
+    def _conflicting(self, conflicts, policy, metrics):
+        """Return a transaction which conflicts the given number of times.
+
+        Returns the function, and a list of the attempts made.
+        """
+        s = stm.STM(self.client, retry_policy=policy, metrics=metrics)
+        attempts = []
+
+        @s.retried_transaction()
+        def _txn(s):
+            attempts.append(s.get("k"))
+            if len(attempts) <= conflicts:
+                self.client.put("k", str(len(attempts)))
+            s.put("other", "1")
+
+        return _txn, attempts
+
+    def test_retry_delays(self):
+        policy = stm.RetryPolicy(initial=0.01, maximum=0.05, multiplier=2)
+        delays = [policy.get_delay(attempt) for attempt in range(1, 100)]
+        # The first retry is immediate, and later delays are jittered.
+        self.assertEqual(0, delays[0])
+        self.assertTrue(all(0 <= delay <= 0.05 for delay in delays))
+        self.assertGreater(len(set(delays[5:])), 1)
+        self.addCleanup(setattr, stm, "random", stm.random)
+        stm.random = _UpperBound()
+        self.assertEqual([0, 0.01, 0.02, 0.04, 0.05, 0.05],
+                         [policy.get_delay(attempt)
+                          for attempt in range(1, 7)])
+
+    def test_retry_attempts(self):
+        clock = self._fake_clock()
+        metrics = stm.Metrics()
+        txn, attempts = self._conflicting(
+            100, stm.RetryPolicy(attempts=5), metrics)
+        self.assertRaises(stm.Conflict, txn)
+        self.assertEqual(5, len(attempts))
+        # Each attempt sees the value written by the previous one. Only the
+        # third and later attempts wait, as the first retry uses the values
+        # read by the failed commit.
+        self.assertEqual([None, "1", "2", "3", "4"], attempts)
+        self.assertEqual(3, len(clock.sleeps))
+        snapshot = metrics.to_dict()
+        self.assertEqual((0, 1), (snapshot["transactions"],
+                                  snapshot["failures"]))
+        self.assertEqual(5, snapshot["attempts"]["max"])
+        self.assertEqual([("k", 5)], snapshot["conflicts"])
+        self.assertEqual(5, snapshot["commit_latency"]["count"])
+
+    def test_retry_budget(self):
+        clock = self._fake_clock()
+        self.addCleanup(setattr, stm, "random", stm.random)
+        stm.random = _UpperBound()
+        policy = stm.RetryPolicy(attempts=100, initial=1, maximum=1,
+                                 budget=2.5)
+        txn, attempts = self._conflicting(100, policy, stm.Metrics())
+        self.assertRaises(stm.Conflict, txn)
+        # A third wait would take the transaction over its budget.
+        self.assertEqual([1, 1], clock.sleeps)
+        self.assertEqual(4, len(attempts))
+
+    def test_retry_metrics(self):
+        clock = self._fake_clock()
+        metrics = stm.Metrics()
+        txn, attempts = self._conflicting(1, stm.RetryPolicy(), metrics)
+        txn()
+        self.assertEqual(2, len(attempts))
+        self.assertEqual([], clock.sleeps)
+        snapshot = metrics.to_dict()
+        self.assertEqual((1, 0), (snapshot["transactions"],
+                                  snapshot["failures"]))
+        self.assertEqual([(2, 1)], snapshot["attempts"]["buckets"])
+        self.assertEqual([("k", 1)], snapshot["conflicts"])
+        self.assertEqual(2, snapshot["commit_latency"]["count"])
+
+    def _increment(self):
+        s = stm.STM(self.client)
+
+        @s.retried_transaction()
+        def increment(s):
+            s.put("counter", str(int(s.get("counter") or 0) + 1))
+
+        for _ in range(10):
+            increment()
+
+    def test_concurrent_increments(self):
+        threads = [threading.Thread(target=self._increment)
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual("40", self.client.get("counter")[0])
+
+    def test_snapshot_isolation(self):
+        self.client.put("a", "1")
+        self.client.put("b", "1")
+        s = stm.STM(self.client, isolation=stm.SERIALIZABLE_SNAPSHOT)
+        with s.transaction():
+            self.assertEqual("1", s.get("a"))
+            self.client.put("b", "2")
+            self.assertEqual("1", s.get("b"))
+
+
+class TestBatcher(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBatcher, self).setUp()
+        self.client = fake_etcd.client(latency=0.01)
+        self.batcher = batcher.Batcher(self.client, max_in_flight=1)
+
+    def test_concurrent_reads(self):
+        for i in range(20):
+            self.client.put("k%d" % i, str(i))
+        results = {}
+
+        def _read(i):
+            response = self.batcher.get_response("k%d" % i)
+            results[i] = response.kvs[0].value
+
+        threads = [threading.Thread(target=_read, args=(i,))
+                   for i in range(20)]
+        rpcs = sum(self.client.rpcs.values())
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict((i, str(i)) for i in range(20)), results)
+        # Reads queued behind the first are sent together.
+        self.assertLess(sum(self.client.rpcs.values()) - rpcs, 5)
+
+    def test_revision(self):
+        self.client.put("k", "a")
+        revision = self.client.revision
+        self.client.put("k", "b")
+        response = self.batcher.get_response("k", revision)
+        self.assertEqual("a", response.kvs[0].value)
+        self.assertEqual([], self.batcher.get_response("missing").kvs)
+
+
+class TestClientPool(unittest.TestCase):
+
+    def setUp(self):
+        super(TestClientPool, self).setUp()
+        self.clients = [fake_etcd.client(), fake_etcd.client()]
+        self.pool = pool.ClientPool(self.clients, health_interval=0.01)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestClientPool, self).tearDown()
+
+    def _fail(self, client):
+        def _raise(*args, **kwargs):
+            raise etcd3.exceptions.ConnectionFailedError()
+        client.get_response = client.put = _raise
+
+    def test_round_robin(self):
+        for _ in range(4):
+            self.pool.get_response("k")
+        self.assertEqual([2, 2], [client.rpcs["range"]
+                                  for client in self.clients])
+
+    def test_failover(self):
+        self._fail(self.clients[0])
+        for _ in range(4):
+            self.assertEqual([], self.pool.get_response("k").kvs)
+        self.assertEqual(4, self.clients[1].rpcs["range"])
+        self.assertEqual(set([self.clients[0]]), self.pool.unhealthy)
+        # Later requests only go to the healthy client.
+        self.pool.put("k", "v")
+        self.assertEqual(1, self.clients[1].rpcs["put"])
+        # Once the client recovers, it is used again.
+        del self.clients[0].get_response, self.clients[0].put
+        deadline = time.time() + 5
+        while self.pool.unhealthy and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(set(), self.pool.unhealthy)
+
+    def test_writes_not_retried(self):
+        self._fail(self.clients[0])
+        self._fail(self.clients[1])
+        self.assertRaises(etcd3.exceptions.ConnectionFailedError,
+                          self.pool.put, "k", "v")
+        self.assertRaises(etcd3.exceptions.ConnectionFailedError,
+                          self.pool.get_response, "k")
+
+    def test_parse_endpoints(self):
+        self.assertEqual([("a", 2379), ("localhost", 2380)],
+                         pool.parse_endpoints("a:2379, :2380"))
+
+
+class _LeaseGrant(grpc.UnaryUnaryMultiCallable):
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, request, *args, **kwargs):
+        lease = self.client.lease(request.TTL)
+        return etcdrpc.LeaseGrantResponse(ID=lease.id, TTL=request.TTL)
+
+    def with_call(self, *args, **kwargs):
+        raise NotImplementedError()
+
+    future = with_call
+
+
+class _LeaseKeepAlive(grpc.StreamStreamMultiCallable):
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, requests, *args, **kwargs):
+        for request in requests:
+            for info in self.client.refresh_lease(request.ID):
+                yield etcdrpc.LeaseKeepAliveResponse(ID=request.ID,
+                                                     TTL=info.TTL)
+
+
+class _LeaseStub(object):
+    """Lease stub with the method types of gRPC, served by a fake client."""
+
+    def __init__(self, client):
+        self.LeaseGrant = _LeaseGrant(client)
+        self.LeaseKeepAlive = _LeaseKeepAlive(client)
+
+
+def _grpc_client(client):
+    """Return an etcd3 client whose lease requests are served by client."""
+    # The channel connects lazily, so is never used.
+    grpc_client = etcd3.client()
+    grpc_client.leasestub = _LeaseStub(client)
+    return grpc_client
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_streaming(self):
+        client = _grpc_client(fake_etcd.client())
+        operation_stats = stats.OperationStats()
+        etcdclient.instrument(client, operation_stats.record_rpc)
+        lease = client.lease(10)
+        for _ in range(2):
+            self.assertEqual([10], [response.TTL
+                                    for response in lease.refresh()])
+        self.assertEqual({"LeaseGrant": 1, "LeaseKeepAlive": 2},
+                         operation_stats.to_dict()["rpcs"])
+        background = operation_stats.to_dict()["operations"]["background"]
+        self.assertTrue(background["bytes_sent"])
+        self.assertTrue(background["bytes_received"])
+
+
+class TestEtcdFSV2(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEtcdFSV2, self).setUp()
+        self.fs = fuse_etcd_v2.EtcdFSV2(client=fake_etcd.client())
+        self.fs.init("/")
+
+    def tearDown(self):
+        self.fs.destroy("/")
+        super(TestEtcdFSV2, self).tearDown()
+
+    def test_write_read(self):
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        data = "x" * 100000
+        self.assertEqual(len(data), self.fs.write("/f", data, 0, fd))
+        self.fs.release("/f", fd)
+        fd = self.fs.open("/f", os.O_RDONLY)
+        self.assertEqual(data, self.fs.read("/f", 200000, 0, fd))
+        self.assertEqual(len(data), self.fs.getattr("/f")["st_size"])
+
+    def test_readdir(self):
+        self.fs.mkdir("/d", 0o755)
+        self.fs.release("/d/f", self.fs.create("/d/f", stat.S_IFREG | 0o644))
+        self.assertEqual([".", "..", "d"], list(self.fs.readdir("/", None)))
+        self.assertEqual([".", "..", "f"], list(self.fs.readdir("/d", None)))
+
+    def test_readdir_batches(self):
+        names = ["f%02d" % i for i in range(25)]
+        for name in names:
+            self.fs.release("/" + name,
+                            self.fs.create("/" + name, stat.S_IFREG | 0o644))
+        batch, fuse_etcd_v2.READDIR_BATCH = fuse_etcd_v2.READDIR_BATCH, 10
+        try:
+            rpcs = self.fs.client.rpcs["range"]
+            self.assertEqual(names, list(self.fs.readdir("/", None))[2:])
+            self.assertEqual(3, self.fs.client.rpcs["range"] - rpcs)
+        finally:
+            fuse_etcd_v2.READDIR_BATCH = batch
+
+    def test_negative_lookup(self):
+        self._wait_for_caches(self.fs)
+        self.assertRaises(OSError, self.fs.getattr, "/missing")
+        rpcs = sum(self.fs.client.rpcs.values())
+        for _ in range(3):
+            self.assertRaises(OSError, self.fs.getattr, "/missing")
+        self.assertEqual(0, sum(self.fs.client.rpcs.values()) - rpcs)
+        # Created locally.
+        self.fs.release("/missing",
+                        self.fs.create("/missing", stat.S_IFREG | 0o644))
+        self.assertTrue(self.fs.getattr("/missing"))
+        # Created through another mount, and seen through the watch.
+        self.assertRaises(OSError, self.fs.getattr, "/other")
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client)
+        fs.init("/")
+        fs.release("/other", fs.create("/other", stat.S_IFREG | 0o644))
+        fs.destroy("/")
+        deadline = time.time() + 5
+        while (self.fs.dentry_cache.get(self.fs._get_dentry_key(
+                   fuse_etcd_v2.ROOT_INO, "other")) is None and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertTrue(self.fs.getattr("/other"))
+
+    def test_tombstone_revision(self):
+        client = fake_etcd.client()
+        fs = fuse_etcd_v2.EtcdFSV2(client=client)
+        cache = fs.dentry_cache
+        revision = client.get_response("dentry/").header.revision
+        events, cancel = client.watch_prefix("dentry/",
+                                             start_revision=revision + 1)
+        # The watch is established, but has not yet applied these changes.
+        cache.revision = revision
+        client.put("dentry/1/f", fs._encode_ino(2))
+        client.delete("dentry/1/f")
+        self.assertIsNone(fs._get_cached(cache, "dentry/1/f"))
+        for _ in range(2):
+            cache._apply(next(events))
+            self.assertEqual(None, cache.get_entry("dentry/1/f")[0])
+        cancel()
+
+    def test_file_handles(self):
+        self.fs.release("/f", self.fs.create("/f", stat.S_IFREG | 0o644))
+        fds = [self.fs.open("/f", os.O_RDONLY) for _ in range(2000)]
+        self.assertEqual(2000, len(set(fds)))
+        self.fs.release("/f", fds[10])
+        self.assertRaises(FuseOSError, self.fs.read, "/f", 1, 0, fds[10])
+        self.assertEqual(fds[10], self.fs.open("/f", os.O_RDONLY))
+        for fd in fds:
+            self.fs.release("/f", fd)
+
+    def test_readdir_prefetch(self):
+        self.fs.mkdir("/d", 0o755)
+        names = ["f%d" % i for i in range(5)]
+        for name in names:
+            self.fs.release("/d/" + name,
+                            self.fs.create("/d/" + name, stat.S_IFREG | 0o644))
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client)
+        fs.init("/")
+        self._wait_for_caches(fs)
+        self.assertEqual(names, list(fs.readdir("/d", None))[2:])
+        rpcs = sum(fs.client.rpcs.values())
+        for name in names:
+            self.assertTrue(stat.S_ISREG(fs.getattr("/d/" + name)["st_mode"]))
+        self.assertEqual(0, sum(fs.client.rpcs.values()) - rpcs)
+        fs.destroy("/")
+
+    def test_batch_reads(self):
+        names = ["/f%d" % i for i in range(10)]
+        for name in names:
+            self.fs.release(name, self.fs.create(name, stat.S_IFREG | 0o644))
+        # Without caches, every getattr reads from etcd.
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client, meta_cache_size=0,
+                                   batch_reads=True)
+        fs.init("/")
+        results = {}
+
+        def _getattr(name):
+            results[name] = fs.getattr(name)["st_ino"]
+
+        threads = [threading.Thread(target=_getattr, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict((name, self.fs.getattr(name)["st_ino"])
+                              for name in names), results)
+        fs.destroy("/")
+
+    def test_rename_unlink(self):
+        fd = self.fs.create("/a", stat.S_IFREG | 0o644)
+        self.fs.write("/a", "data", 0, fd)
+        self.fs.release("/a", fd)
+        self.fs.rename("/a", "/b")
+        self.assertRaises(FuseOSError, self.fs.getattr, "/a")
+        fd = self.fs.open("/b", os.O_RDONLY)
+        self.assertEqual("data", self.fs.read("/b", 10, 0, fd))
+        self.fs.unlink("/b")
+        with self.assertRaises(FuseOSError) as ctx:
+            self.fs.getattr("/b")
+        self.assertEqual(errno.ENOENT, ctx.exception.errno)
+
+    def test_rename_directory(self):
+        self.fs.mkdir("/d", 0o755)
+        self.fs.mkdir("/d/e", 0o755)
+        fd = self.fs.create("/d/e/f", stat.S_IFREG | 0o644)
+        self.fs.write("/d/e/f", "data", 0, fd)
+        rpcs = sum(self.fs.client.rpcs.values())
+        self.fs.rename("/d", "/g")
+        # Only directory entries and metadata are written.
+        self.assertLessEqual(sum(self.fs.client.rpcs.values()) - rpcs, 8)
+        self.assertEqual([".", "..", "g"], list(self.fs.readdir("/", None)))
+        self.assertEqual("data", self.fs.read("/g/e/f", 10, 0, fd))
+        self.fs.release("/g/e/f", fd)
+        self.assertRaises(FuseOSError, self.fs.getattr, "/d/e/f")
+        with self.assertRaises(FuseOSError) as ctx:
+            self.fs.rename("/g", "/g/e/h")
+        self.assertEqual(errno.EINVAL, ctx.exception.errno)
+
+    def test_link(self):
+        fd = self.fs.create("/a", stat.S_IFREG | 0o644)
+        self.fs.write("/a", "data", 0, fd)
+        self.fs.release("/a", fd)
+        self.fs.link("/b", "/a")
+        self.assertEqual(2, self.fs.getattr("/b")["st_nlink"])
+        self.assertEqual(self.fs.getattr("/a")["st_ino"],
+                         self.fs.getattr("/b")["st_ino"])
+        self.fs.unlink("/a")
+        self.assertEqual(1, self.fs.getattr("/b")["st_nlink"])
+        fd = self.fs.open("/b", os.O_RDONLY)
+        self.assertEqual("data", self.fs.read("/b", 10, 0, fd))
+        self.fs.release("/b", fd)
+        self.fs.unlink("/b")
+        self.assertEqual([], list(self.fs.client.get_prefix("block/")))
+
+    def test_migrate_paths(self):
+        # Layout of filesystems created by earlier versions.
+        client = fake_etcd.client()
+        meta = fuse_etcd_v2.Meta(1, 1, 0, stat.S_IFDIR | 0o755, 1, 1, 4096, 0)
+        client.put("meta/", meta.encode())
+        client.put("meta/d", meta.encode())
+        client.put("dirent//d", "")
+        meta = fuse_etcd_v2.Meta(1, 1, 0, stat.S_IFREG | 0o644, 1, 1, 4, 0)
+        client.put("meta/d/f", meta.encode())
+        client.put("dirent/d//f", "")
+        client.put("data/d/f/00000000", "data")
+        fs = fuse_etcd_v2.EtcdFSV2(client=client, codec="zlib")
+        fs.init("/")
+        self.assertEqual(["f"], list(fs.readdir("/d", None))[2:])
+        fd = fs.open("/d/f", os.O_RDONLY)
+        self.assertEqual("data", fs.read("/d/f", 10, 0, fd))
+        fs.release("/d/f", fd)
+        fs.destroy("/")
+        for prefix in ("meta/", "dirent", "data/"):
+            self.assertEqual([], list(client.get_prefix(prefix)))
+
+    def test_migrate_single_values(self):
+        # Layout of the first version, with JSON metadata, no directory
+        # entries, and the data of each file in a single value.
+        client = fake_etcd.client()
+        meta = dict(atime=1, ctime=1, gid=0, mtime=1, nlink=1, uid=0)
+        client.put("meta/", json.dumps(dict(meta, mode=stat.S_IFDIR | 0o777,
+                                            size=4096)))
+        client.put("meta/d", json.dumps(dict(meta, mode=stat.S_IFDIR | 0o755,
+                                             size=4096)))
+        data = "x" * fuse_etcd_v2.BLOCK_SIZE + "bar"
+        client.put("meta/d/f", json.dumps(dict(meta, mode=stat.S_IFREG | 0o644,
+                                               size=len(data))))
+        client.put("data/d/f", data)
+        client.put("meta/e", json.dumps(dict(meta, mode=stat.S_IFREG | 0o644,
+                                             size=0)))
+        client.put("data/e", "")
+        fs = fuse_etcd_v2.EtcdFSV2(client=client)
+        fs.init("/")
+        self.assertEqual(["d", "e"], sorted(list(fs.readdir("/", None))[2:]))
+        fd = fs.open("/d/f", os.O_RDONLY)
+        self.assertEqual(data, fs.read("/d/f", len(data) + 10, 0, fd))
+        fs.release("/d/f", fd)
+        self.assertEqual(0, fs.getattr("/e")["st_size"])
+        fs.destroy("/")
+        for prefix in ("meta/", "data/"):
+            self.assertEqual([], list(client.get_prefix(prefix)))
+
+    def test_rmdir_not_empty(self):
+        self.fs.mkdir("/d", 0o755)
+        self.fs.release("/d/f", self.fs.create("/d/f", stat.S_IFREG | 0o644))
+        with self.assertRaises(FuseOSError) as ctx:
+            self.fs.rmdir("/d")
+        self.assertEqual(errno.ENOTEMPTY, ctx.exception.errno)
+        self.fs.unlink("/d/f")
+        self.fs.rmdir("/d")
+        self.assertEqual([".", ".."], list(self.fs.readdir("/", None)))
+
+    def test_create_one_round_trip(self):
+        self._wait_for_caches(self.fs)
+        self.fs.mkdir("/d", 0o755)
+        mtime = self.fs.getattr("/d")["st_mtime"]
+        rpcs = sum(self.fs.client.rpcs.values())
+        self.fs.release("/d/f", self.fs.create("/d/f", stat.S_IFREG | 0o644))
+        self.assertEqual(1, sum(self.fs.client.rpcs.values()) - rpcs)
+        self.assertGreaterEqual(self.fs.getattr("/d")["st_mtime"], mtime)
+
+    def test_scattered_writeback(self):
+        # Each write touches a different block, which is written whole.
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client, writeback=True)
+        fs.init("/")
+        fd = fs.create("/f", stat.S_IFREG | 0o644)
+        for i in range(256):
+            fs.write("/f", "x" * 4096, i * fuse_etcd_v2.BLOCK_SIZE, fd)
+        fs.release("/f", fd)
+        fd = fs.open("/f", os.O_RDONLY)
+        data = fs.read("/f", 256 * fuse_etcd_v2.BLOCK_SIZE, 0, fd)
+        fs.release("/f", fd)
+        self.assertEqual(256 * 4096, data.count("x"))
+        fs.destroy("/")
+
+    def test_writeback_read_other_handle(self):
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client, writeback=True)
+        fs.init("/")
+        fd = fs.create("/f", stat.S_IFREG | 0o644)
+        fs.write("/f", "hello", 0, fd)
+        other_fd = fs.open("/f", os.O_RDONLY)
+        self.assertEqual(5, fs.getattr("/f")["st_size"])
+        self.assertEqual("hello", fs.read("/f", 10, 0, other_fd))
+        fs.release("/f", other_fd)
+        fs.release("/f", fd)
+        fs.destroy("/")
+
+    def test_large_write(self):
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.assertEqual(len(data), self.fs.write("/f", data, 3, fd))
+        self.assertEqual("\0" * 3 + data,
+                         self.fs.read("/f", len(data) + 3, 0, fd))
+        self.fs.release("/f", fd)
+
+    def test_open_existing(self):
+        self._wait_for_caches(self.fs)
+        self.fs.release("/f", self.fs.create("/f", stat.S_IFREG | 0o644))
+        stm.METRICS.reset()
+        rpcs = sum(self.fs.client.rpcs.values())
+        self.fs.release("/f", self.fs.open("/f", os.O_RDONLY))
+        with self.assertRaises(FuseOSError) as ctx:
+            self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.assertEqual(errno.EEXIST, ctx.exception.errno)
+        self.assertEqual(0, sum(self.fs.client.rpcs.values()) - rpcs)
+        self.assertEqual([], stm.METRICS.to_dict()["conflicts"])
+
+    def _wait_for_caches(self, fs):
+        while (fs.meta_cache.revision is None or
+               fs.dentry_cache.revision is None):
+            time.sleep(0.01)
+
+    def test_concurrent_creates(self):
+        # Every create in a directory updates the directory, so concurrent
+        # creates conflict, and must not run out of retries.
+        client = fake_etcd.client(latency=0.001)
+        mounts = [fuse_etcd_v2.EtcdFSV2(client=client) for _ in range(3)]
+        for fs in mounts:
+            fs.init("/")
+        mounts[0].mkdir("/d", 0o755)
+        errors = []
+
+        def _create(fs, thread):
+            for i in range(30):
+                path = "/d/%d-%d" % (thread, i)
+                try:
+                    fs.release(path, fs("create", path,
+                                        stat.S_IFREG | 0o644))
+                except FuseOSError as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=_create, args=(mounts[i % 3], i))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(180, len(list(mounts[0].readdir("/d", None))) - 2)
+        for fs in mounts:
+            fs.destroy("/")
+
+    def test_conflict_exhausted(self):
+        fs = fuse_etcd_v2.EtcdFSV2(client=fake_etcd.client(),
+                                   retry_policy=stm.RetryPolicy(attempts=1))
+        fs.init("/")
+
+        def _conflict(s, ino):
+            raise stm.Conflict(["inode/"])
+
+        fs._touch_dir = _conflict
+        with self.assertRaises(FuseOSError) as cm:
+            fs("create", "/f", stat.S_IFREG | 0o644)
+        self.assertEqual(errno.EAGAIN, cm.exception.errno)
+        fs.destroy("/")
+
+    def test_readahead(self):
+        self._wait_for_caches(self.fs)
+        data = os.urandom(1024 * 1024)
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.fs.write("/f", data, 0, fd)
+        self.fs.release("/f", fd)
+        fd = self.fs.open("/f", os.O_RDONLY)
+        rpcs = sum(self.fs.client.rpcs.values())
+        chunks = [self.fs.read("/f", 128 * 1024, offset, fd)
+                  for offset in xrange(0, len(data), 128 * 1024)]
+        self.assertEqual(data, "".join(chunks))
+        # The first read fetches 640 KiB, and the fifth the remainder.
+        self.assertEqual(2, sum(self.fs.client.rpcs.values()) - rpcs)
+
+    def test_read_cache_invalidation(self):
+        other = fuse_etcd_v2.EtcdFSV2(client=self.fs.client)
+        other.init("/")
+        self._wait_for_caches(self.fs)
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.fs.write("/f", "a" * 10, 0, fd)
+        self.assertEqual("a" * 10, self.fs.read("/f", 10, 0, fd))
+        # A local write.
+        self.fs.write("/f", "b", 0, fd)
+        self.assertEqual("b" + "a" * 9, self.fs.read("/f", 10, 0, fd))
+        # A write through another mount.
+        other_fd = other.open("/f", os.O_WRONLY)
+        other.write("/f", "c", 1, other_fd)
+        other.release("/f", other_fd)
+        other.destroy("/")
+        deadline = time.time() + 5
+        while (self.fs.read("/f", 10, 0, fd) != "bc" + "a" * 8 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual("bc" + "a" * 8, self.fs.read("/f", 10, 0, fd))
+        self.fs.release("/f", fd)
+
+    def test_json_meta(self):
+        # Metadata written before the binary encoding is still read.
+        meta = fuse_etcd_v2.Meta(1, 2, 3, stat.S_IFREG | 0o644, 4, 1, 0, 5)
+        meta_key = self.fs._get_inode_key(2)
+        self.fs.client.put(meta_key, json.dumps(dict(
+            (attr, getattr(meta, attr)) for attr in meta.attrs)))
+        self.fs.client.put(
+            self.fs._get_dentry_key(fuse_etcd_v2.ROOT_INO, "f"),
+            self.fs._encode_ino(2))
+        attr = meta.to_attr()
+        attr["st_ino"] = 2
+        self.assertEqual(attr, self.fs.getattr("/f"))
+        self.fs.chmod("/f", stat.S_IFREG | 0o600)
+        value, _ = self.fs.client.get(meta_key)
+        self.assertEqual(fuse_etcd_v2.Meta.VERSION, ord(value[0]))
+        self.assertEqual(stat.S_IFREG | 0o600,
+                         fuse_etcd_v2.Meta.decode(value).mode)
+
+    def test_compression(self):
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.fs.client, codec="zlib")
+        fs.init("/")
+        data = "log line\n" * 10000
+        fd = fs.create("/f", stat.S_IFREG | 0o644)
+        fs.write("/f", data, 0, fd)
+        fs.release("/f", fd)
+        fs.destroy("/")
+        values = [value for value, _ in self.fs.client.get_prefix(
+            self.fs._get_data_key(self.fs._lookup("/f")))]
+        self.assertEqual(["\x01"] * 2, [value[0] for value in values])
+        self.assertLess(sum(len(value) for value in values), len(data) // 10)
+        # Data compressed by another mount is readable, and mixed with data
+        # this mount writes uncompressed.
+        fd = self.fs.open("/f", os.O_RDWR)
+        self.fs.write("/f", "x" * 10, 5, fd)
+        self.assertEqual(data[:5] + "x" * 10 + data[15:],
+                         self.fs.read("/f", len(data), 0, fd))
+        self.assertEqual(len(data), self.fs.getattr("/f")["st_size"])
+
+    def test_stats(self):
+        fd = self.fs("create", "/f", stat.S_IFREG | 0o644)
+        self.fs("write", "/f", "data", 0, fd)
+        self.fs("release", "/f", fd)
+        size = self.fs("getattr", fuse_etcd_v2.STATS_PATH)["st_size"]
+        fd = self.fs("open", fuse_etcd_v2.STATS_PATH, os.O_RDONLY)
+        stats = json.loads(self.fs("read", fuse_etcd_v2.STATS_PATH, size, 0,
+                                   fd))
+        self.fs("release", fuse_etcd_v2.STATS_PATH, fd)
+        write = stats["filesystem"]["operations"]["write"]
+        self.assertEqual(1, write["latency"]["count"])
+        self.assertGreater(write["rpcs"], 0)
+        self.assertEqual([".", "..", "f"], list(self.fs.readdir("/", None)))
+
+    def test_readdir_stats(self):
+        for i in range(5):
+            self.fs.release("/f%d" % i,
+                            self.fs.create("/f%d" % i, stat.S_IFREG | 0o644))
+        self.assertEqual(7, len(list(self.fs("readdir", "/", None))))
+        readdir = self.fs.stats.to_dict()["operations"]["readdir"]
+        self.assertEqual(1, readdir["latency"]["count"])
+        self.assertGreater(readdir["rpcs"], 0)
+        self.assertEqual(0, readdir["errors"])
+
+
+class TestEtcdFSV2WriteLocks(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEtcdFSV2WriteLocks, self).setUp()
+        self.client = fake_etcd.client()
+        self.fs = fuse_etcd_v2.EtcdFSV2(client=self.client, write_locks=True)
+        self.fs.init("/")
+        self.other = fuse_etcd_v2.EtcdFSV2(client=self.client,
+                                           write_locks=True)
+        self.other.init("/")
+
+    def tearDown(self):
+        self.other.destroy("/")
+        self.fs.destroy("/")
+        super(TestEtcdFSV2WriteLocks, self).tearDown()
+
+    def test_writers_wait(self):
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        # Handles in the same mount share the lock.
+        fd2 = self.fs.open("/f", os.O_WRONLY)
+        self.fs.release("/f", fd2)
+        opened = threading.Event()
+
+        def _append():
+            other_fd = self.other.open("/f", os.O_WRONLY)
+            opened.set()
+            self.other.write("/f", "b", 3, other_fd)
+            self.other.release("/f", other_fd)
+
+        thread = threading.Thread(target=_append)
+        thread.start()
+        # Writes are buffered until the file is flushed.
+        for i in range(3):
+            self.fs.write("/f", "a", i, fd)
+        self.assertEqual([], list(self.client.get_prefix("block/")))
+        self.assertFalse(opened.wait(0.1))
+        self.fs.release("/f", fd)
+        thread.join()
+        fd = self.other.open("/f", os.O_RDONLY)
+        self.assertEqual("aaab", self.other.read("/f", 10, 0, fd))
+        self.other.release("/f", fd)
+
+    def test_readers_do_not_wait(self):
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        other_fd = self.other.open("/f", os.O_RDONLY)
+        self.other.release("/f", other_fd)
+        self.fs.release("/f", fd)
+
+    def _short_lease_mounts(self):
+        self.other.destroy("/")
+        self.fs.destroy("/")
+        self.fs = fuse_etcd_v2.EtcdFSV2(client=self.client, write_locks=True,
+                                        write_lock_ttl=1)
+        self.fs.init("/")
+        self.other = fuse_etcd_v2.EtcdFSV2(client=self.client,
+                                           write_locks=True, write_lock_ttl=1)
+        self.other.init("/")
+
+    def test_lease_kept_alive(self):
+        self._short_lease_mounts()
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        # The lock is held while the file is open, even if it is not written.
+        time.sleep(1.5)
+        self.assertRaises(FuseOSError, self.other.open, "/f",
+                          os.O_WRONLY)
+        self.fs.write("/f", "a", 0, fd)
+        self.fs.release("/f", fd)
+        other_fd = self.other.open("/f", os.O_WRONLY)
+        self.other.release("/f", other_fd)
+
+    def test_lease_kept_alive_grpc(self):
+        self._short_lease_mounts()
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        # Refresh the lease through an instrumented gRPC client, as a mount
+        # using etcd does.
+        grpc_client = _grpc_client(self.client)
+        etcdclient.instrument(grpc_client, self.fs.stats.record_rpc)
+        write_lock = self.fs.inode_locks.values()[0]
+        write_lock.lock.lease.etcd_client = grpc_client
+        time.sleep(1.5)
+        self.assertTrue(write_lock.acquired)
+        self.assertRaises(FuseOSError, self.other.open, "/f", os.O_WRONLY)
+        self.assertTrue(self.fs.stats.to_dict()["rpcs"]["LeaseKeepAlive"])
+        self.fs.release("/f", fd)
+
+    def test_refresh_fails(self):
+        self._short_lease_mounts()
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        write_lock = self.fs.inode_locks.values()[0]
+
+        def _raise():
+            raise etcd3.exceptions.ConnectionFailedError()
+
+        write_lock.lock.refresh = _raise
+        time.sleep(1.5)
+        # The lock is given up once its lease would have expired.
+        self.assertFalse(write_lock.acquired)
+        del write_lock.lock.refresh
+        self.fs.write("/f", "a", 0, fd)
+        self.assertTrue(write_lock.acquired)
+        self.fs.release("/f", fd)
+
+    def test_lost_lock(self):
+        self._short_lease_mounts()
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        write_lock = self.fs.inode_locks.values()[0]
+        self.client.revoke_lease(write_lock.lock.lease.id)
+        time.sleep(0.5)
+        self.assertFalse(write_lock.acquired)
+        # Another mount takes the lock, so writes fail until it is released.
+        other_fd = self.other.open("/f", os.O_WRONLY)
+        self.assertRaises(FuseOSError, self.fs.write, "/f", "a", 0, fd)
+        self.other.release("/f", other_fd)
+        self.fs.write("/f", "a", 0, fd)
+        self.assertTrue(write_lock.acquired)
+        self.fs.release("/f", fd)
+
+
+class TestEtcdFSV2Atime(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEtcdFSV2Atime, self).setUp()
+        self.client = fake_etcd.client()
+        self.fs = None
+
+    def tearDown(self):
+        self.fs.destroy("/")
+        super(TestEtcdFSV2Atime, self).tearDown()
+
+    def _mount(self, atime):
+        self.fs = fuse_etcd_v2.EtcdFSV2(client=self.client, atime=atime)
+        self.fs.init("/")
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.fs.write("/f", "data", 0, fd)
+        self.fs.release("/f", fd)
+        self.meta_key = self.fs._get_inode_key(self.fs._lookup("/f"))
+
+    def _get_meta(self):
+        value, kv = self.client.get(self.meta_key)
+        return fuse_etcd_v2.Meta.decode(value), kv.mod_revision
+
+    def _backdate(self, seconds, atime_seconds=None):
+        """Move the times of the file back, as if it was written earlier."""
+        meta, _ = self._get_meta()
+        meta.mtime -= seconds
+        meta.ctime -= seconds
+        meta.atime -= seconds if atime_seconds is None else atime_seconds
+        self.client.put(self.meta_key, meta.encode())
+
+    def _read(self):
+        """Read the file, and return its access time and mod_revision."""
+        fd = self.fs.open("/f", os.O_RDONLY)
+        self.assertEqual("data", self.fs.read("/f", 10, 0, fd))
+        self.fs.release("/f", fd)
+        meta, mod_revision = self._get_meta()
+        return meta.atime, mod_revision
+
+    def test_relatime(self):
+        self._mount(fuse_etcd_v2.ATIME_RELATIME)
+        # A write updates the access time along with the modification time,
+        # which must not stop later reads from updating it.
+        self._backdate(10)
+        atime, mod_revision = self._read()
+        self.assertGreaterEqual(atime, int(time.time()) - 1)
+        # Reads in the same second would not change the access time.
+        if atime == int(time.time()):
+            self.assertEqual((atime, mod_revision), self._read())
+        # An access time newer than the modification time is not updated.
+        self._backdate(10, atime_seconds=5)
+        meta, mod_revision = self._get_meta()
+        self.assertEqual((meta.atime, mod_revision), self._read())
+        # Unless it is more than a day old.
+        self._backdate(2 * fuse_etcd_v2.RELATIME_INTERVAL,
+                       atime_seconds=fuse_etcd_v2.RELATIME_INTERVAL)
+        self.assertGreaterEqual(self._read()[0], int(time.time()) - 1)
+
+    def test_strictatime(self):
+        self._mount(fuse_etcd_v2.ATIME_STRICT)
+        self._backdate(10, atime_seconds=5)
+        atime, mod_revision = self._read()
+        self.assertGreaterEqual(atime, int(time.time()) - 1)
+        self.assertLess(mod_revision, self._read()[1])
+
+    def test_noatime(self):
+        self._mount(fuse_etcd_v2.ATIME_NOATIME)
+        self._backdate(10)
+        meta, mod_revision = self._get_meta()
+        self.assertEqual((meta.atime, mod_revision), self._read())
+
+
+class TestEtcdFSV2Dedup(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEtcdFSV2Dedup, self).setUp()
+        self.client = fake_etcd.client()
+        self.fs = fuse_etcd_v2.EtcdFSV2(client=self.client, dedup=True)
+        self.fs.init("/")
+
+    def tearDown(self):
+        self.fs.destroy("/")
+        super(TestEtcdFSV2Dedup, self).tearDown()
+
+    def _write(self, path, data, offset=0):
+        fd = self.fs.open(path, os.O_WRONLY)
+        self.fs.write(path, data, offset, fd)
+        self.fs.release(path, fd)
+
+    def _read(self, path):
+        fd = self.fs.open(path, os.O_RDONLY)
+        data = self.fs.read(path, 1 << 20, 0, fd)
+        self.fs.release(path, fd)
+        return data
+
+    def _get_prefix(self, prefix):
+        return dict((kv.key, value)
+                    for value, kv in self.client.get_prefix(prefix))
+
+    def test_shared_blocks(self):
+        block = "x" * fuse_etcd_v2.BLOCK_SIZE
+        self._write("/a", block * 2 + "y")
+        self._write("/b", block)
+        self.assertEqual(2, len(self._get_prefix("blob/")))
+        refs = self._get_prefix("blobref/")
+        self.assertEqual(["1", "3"], sorted(refs.values()))
+        self.fs.rename("/a", "/c")
+        self.assertEqual(refs, self._get_prefix("blobref/"))
+        self.assertEqual(block * 2 + "y", self._read("/c"))
+        self.fs.truncate("/c", 10)
+        self.assertEqual("x" * 10, self._read("/c"))
+        self.fs.unlink("/b")
+        self.fs.unlink("/c")
+        self.assertEqual({}, self._get_prefix("blob"))
+        self.assertEqual({}, self._get_prefix("gc/"))
+
+    def test_overwrite(self):
+        self._write("/a", "x" * 100)
+        self._write("/a", "y", 50)
+        self.assertEqual("x" * 50 + "y" + "x" * 49, self._read("/a"))
+        self.assertEqual(["1"], self._get_prefix("blobref/").values())
+        self.assertEqual(1, len(self._get_prefix("blob/")))
+
+    def test_format(self):
+        # The format of an existing filesystem overrides the mount option.
+        fs = fuse_etcd_v2.EtcdFSV2(client=self.client)
+        fs.init("/")
+        self.assertTrue(fs.dedup)
+        fs.destroy("/")
+
+
+class TestEtcdFS(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEtcdFS, self).setUp()
+        self.fs = fuse_etcd.EtcdFS(client=fake_etcd.client())
+
+    def test_write_read(self):
+        fd = self.fs.create("/f", stat.S_IFREG | 0o644)
+        self.fs.write("/f", "data", 0, fd)
+        self.assertEqual("data", self.fs.read("/f", 10, 0, fd))
+        self.assertTrue(stat.S_ISREG(self.fs.getattr("/f")["st_mode"]))
+
+    def test_file_handles(self):
+        self.fs.release("/f", self.fs.create("/f", stat.S_IFREG | 0o644))
+        fds = [self.fs.open("/f", os.O_RDONLY) for _ in range(2000)]
+        self.assertEqual(range(2000), fds)
+        # Closing a file does not renumber other open files.
+        self.fs.release("/f", fds[10])
+        self.assertEqual(11, self.fs._get_file(11).fd)
+        self.assertEqual(10, self.fs.open("/f", os.O_RDONLY))
+        self.assertEqual(2000, self.fs.open("/f", os.O_RDONLY))
+
+    def test_readdir_batches(self):
+        self.fs.mkdir("/d", 0o755)
+        names = ["f%02d" % i for i in range(25)]
+        for name in names:
+            self.fs.create("/d/" + name, stat.S_IFREG | 0o644)
+        batch, fuse_etcd.READDIR_BATCH = fuse_etcd.READDIR_BATCH, 10
+        try:
+            self.assertEqual(names, list(self.fs.readdir("/d", None))[2:])
+        finally:
+            fuse_etcd.READDIR_BATCH = batch
+
+
+if __name__ == '__main__':
+    unittest.main()
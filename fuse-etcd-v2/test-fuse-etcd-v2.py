@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import json
 import os
 import subprocess
 
@@ -67,6 +68,13 @@ class TestFS(unittest.TestCase):
         result = self._read_file("foo")
         self.assertEqual(result, "bar")
 
+    def test_write_read_large(self):
+        # Spans several data blocks, with a partial final block.
+        content = "".join(chr(i % 251) for i in range(300 * 1024))
+        self._write_file("foo", content)
+        result = self._read_file("foo")
+        self.assertEqual(result, content)
+
     def test_list_dir_empty(self):
         result = os.listdir(self._get_path(""))
         self.assertEqual(result, [])
@@ -82,6 +90,14 @@ class TestFS(unittest.TestCase):
         result = os.listdir(self._get_path(""))
         self.assertEqual(sorted(result), sorted(["foo", "bar"]))
 
+    def test_list_dir_nested(self):
+        os.mkdir(self._get_path("dir"))
+        self._write_file("dir/foo", "bar")
+        result = os.listdir(self._get_path(""))
+        self.assertEqual(result, ["dir"])
+        result = os.listdir(self._get_path("dir"))
+        self.assertEqual(result, ["foo"])
+
     def test_rename(self):
         self._write_file("foo", "bar")
         self._rename_file("foo", "baz")
@@ -95,6 +111,19 @@ class TestFS(unittest.TestCase):
         result = self._read_file("foo")
         self.assertEqual(result, "ba")
 
+    def test_truncate_extend(self):
+        self._write_file("foo", "bar")
+        self._truncate_file("foo", 5)
+        result = self._read_file("foo")
+        self.assertEqual(result, "bar\0\0")
+
+    def test_stats(self):
+        self._write_file("foo", "bar")
+        with open(os.path.join(self.mountpoint, ".stats")) as f:
+            stats = json.load(f)
+        self.assertIn("write", stats["filesystem"]["operations"])
+        self.assertNotIn(".stats", os.listdir(self.mountpoint))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,7 @@ import sys
 import errno
 import logging
 import stat
+import threading
 
 import etcd3
 from fuse import FUSE, FuseOSError, LoggingMixIn, Operations
@@ -16,6 +17,9 @@ logging.basicConfig(filename='fuse-etcd.log', filemode='w', level=logging.DEBUG)
 
 MAGIC_DIRECTORY = "__DIRECTORY__"
 
+# Number of keys read per request by readdir.
+READDIR_BATCH = 1000
+
 
 class File(object):
 
@@ -26,33 +30,78 @@ class File(object):
 
 
 class EtcdFS(LoggingMixIn, Operations):
-    def __init__(self):
-        self.client = etcd3.client()
-        self.fds = [None] * 1024
+    def __init__(self, client=None):
+        self.client = client or etcd3.client()
+        # Maps the handle of each open file to its File. Handles of closed
+        # files are kept in free_fds for reuse, so handles stay small.
+        self.fds = {}
+        self.free_fds = []
+        self.fds_lock = threading.Lock()
         self.logger = logging.getLogger('etcdfs')
 
     # Helpers
     # =======
 
     def _create_file(self, path, flags):
-        try:
-            free_fd = self.fds.index(None)
-        except ValueError:
-            # TODO
-            raise
-        self.fds[free_fd] = File(free_fd, path, flags)
-        return self.fds[free_fd]
+        with self.fds_lock:
+            if self.free_fds:
+                fd = self.free_fds.pop()
+            else:
+                # Every handle below the number of open files is in use.
+                fd = len(self.fds)
+            file = self.fds[fd] = File(fd, path, flags)
+            return file
 
     def _get_file(self, fd):
-        return self.fds[fd]
+        try:
+            return self.fds[fd]
+        except KeyError:
+            raise FuseOSError(errno.EBADF)
 
     def _close_file(self, fd):
-        self.fds.pop(fd)
+        with self.fds_lock:
+            if self.fds.pop(fd, None) is not None:
+                self.free_fds.append(fd)
 
     @staticmethod
     def _is_dir(value):
         return value == MAGIC_DIRECTORY
 
+    def _get_range_response(self, key, range_end, limit, revision=None):
+        # etcd3 does not set the limit or revision of range requests, so the
+        # request is sent directly.
+        if not hasattr(self.client, 'kvstub'):
+            return self.client.get_range_response(
+                key, range_end, limit=limit, revision=revision,
+                keys_only=True)
+        request = self.client._build_get_range_request(
+            key, range_end=range_end, keys_only=True)
+        request.limit = limit
+        if revision:
+            request.revision = revision
+        return self.client.kvstub.Range(
+            request, self.client.timeout,
+            credentials=self.client.call_credentials,
+            metadata=self.client.metadata)
+
+    def _iter_prefix(self, prefix):
+        """Yield the keys under a prefix, READDIR_BATCH at a time.
+
+        Batches after the first are read at the revision of the first.
+        """
+        key = prefix
+        range_end = etcd3.utils.increment_last_byte(prefix)
+        revision = None
+        while True:
+            response = self._get_range_response(key, range_end,
+                                                READDIR_BATCH, revision)
+            for kv in response.kvs:
+                yield kv
+            if not response.more or not response.kvs:
+                return
+            revision = revision or response.header.revision
+            key = response.kvs[-1].key + b'\0'
+
     # Filesystem methods
     # ==================
 
@@ -104,7 +153,7 @@ class EtcdFS(LoggingMixIn, Operations):
     def readdir(self, path, fh):
         yield '.'
         yield '..'
-        for _, kv in self.client.get_prefix(path, keys_only=True):
+        for kv in self._iter_prefix(path):
             if os.path.split(kv.key)[0] == path:
                 yield os.path.split(kv.key)[-1]
 